@@ -1,5 +1,55 @@
+import os
+
 grab_def_offset = 3
 
+# hit-or-miss kernel cells that match anything
+dont_care_tokens = {"x", "*"}
+
+# relative size of the second singular value below which a kernel counts as rank-1
+separable_kernel_tolerance = 1e-6
+float_noise_margin = 1e-7
+# shifted-slice taps cost about as much per pixel as log2(pixels) for an FFT round trip
+# (measured on RGB images from 256x256 to 2048x2048, 3x3 to 15x15 kernels)
+fft_crossover_ratio = 1.2
+# sorting windows loses to the running histogram from 11x11 up (1 MP RGB, ~4.5 s either way)
+median_histogram_min_radius = 5
+median_band_elements = 1 << 24
+
+clahe_tiles = 8
+clahe_clip_limit = 2.0
+
+# linear scaling slider events closer together than this collapse into one render
+scaling_debounce_ms = 15
+
+# PPM payloads from this size up stay on disk and are processed tile by tile
+tiled_image_min_bytes = 1 << 28
+tile_size = 1024
+# longest side of the in-memory copy of a tiled image used for hovering and previews
+tiled_overview_size = 2048
+tile_cache_tiles = 64
+
+# below this many pixels starting the bands costs more than it saves
+parallel_min_pixels = 1 << 20
+# several bands per process so a slow band does not hold up the rest
+parallel_bands_per_worker = 4
+
+# cached outputs of pipeline stages, least recently used ones go first
+pipeline_cache_bytes = 1 << 30
+# evicted stage outputs are kept there compressed, also across sessions
+result_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "graphics", "results")
+result_cache_disk_bytes = 4 << 30
+result_cache_compression = 1
+# written at exit, most recently used first; compressing more would hold up quitting
+result_cache_exit_bytes = 128 << 20
+
+# images with this many times the pixels of the widget get a quick filtered proxy first
+progressive_min_ratio = 4
+roi_halo_step = 16
+
+# undo steps are compressed deltas of the changed tiles, the oldest go once they take more than this
+history_bytes = 1 << 29
+history_compression = 1
+
 slider_style_sheet = """
     QSlider::groove:horizontal {
         height: 6px;               
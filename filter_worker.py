@@ -0,0 +1,46 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+class FilterCancelled(Exception):
+    pass
+
+class FilterSignals(QObject):
+    # every signal carries the id of the request it belongs to
+    progress = Signal(int, int)
+    preview = Signal(int, object)
+    finished = Signal(int, object)
+    failed = Signal(int, str)
+
+class FilterTask(QRunnable):
+    # runs job(progress, preview) on a pool thread; job reports progress
+    # between tiles and may hand over a quick preview result, both are where
+    # a cancelled task stops
+    def __init__(self, request_id, job):
+        super().__init__()
+        self.request_id = request_id
+        self.job = job
+        self.cancelled = False
+        self.signals = FilterSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, done, total):
+        if self.cancelled:
+            raise FilterCancelled()
+        self.signals.progress.emit(self.request_id, done * 100 // total)
+
+    def show_preview(self, result):
+        if self.cancelled:
+            raise FilterCancelled()
+        self.signals.preview.emit(self.request_id, result)
+
+    def run(self):
+        try:
+            result = self.job(self.report, self.show_preview)
+        except FilterCancelled:
+            return
+        except Exception as e:
+            # anything escaping a pool thread is lost, the canvas has to hear of it
+            self.signals.failed.emit(self.request_id, str(e) or type(e).__name__)
+            return
+        self.signals.finished.emit(self.request_id, result)
@@ -0,0 +1,204 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from utils import create_ds_kernel
+from constants import (
+    separable_kernel_tolerance, float_noise_margin, fft_crossover_ratio, median_histogram_min_radius,
+    median_band_elements
+)
+
+def kernel_padding(kernel):
+    # offsets produced by create_ds_kernel run from -(n // 2) to (n - 1) // 2
+    y_len, x_len = len(kernel), len(kernel[0])
+    return (y_len // 2, (y_len - 1) // 2), (x_len // 2, (x_len - 1) // 2)
+
+def pad_edges(arr, pad_y, pad_x, dtype=None):
+    if dtype is not None:
+        arr = arr.astype(dtype)
+    return np.pad(arr, (pad_y, pad_x) + ((0, 0),) * (arr.ndim - 2), mode="edge")
+
+def convolve(arr, kernel):
+    pad_y, pad_x = kernel_padding(kernel)
+    ds_kernel = create_ds_kernel([list(row) for row in kernel])
+    padded = pad_edges(arr, pad_y, pad_x, dtype=np.float64)
+    height, width = arr.shape[0], arr.shape[1]
+    top, left = pad_y[0], pad_x[0]
+
+    acc = np.zeros(arr.shape, dtype=np.float64)
+    for mult, dx, dy in ds_kernel:
+        if mult == 0:
+            continue
+        acc += mult * padded[top + dy:top + dy + height, left + dx:left + dx + width]
+
+    return np.clip(acc, 0, 255).astype(np.uint8)
+
+def truncate_like_direct(acc, arr, kernel):
+    # reordered sums can land on the other side of an integer than the direct
+    # loop does; the few samples that close to one are summed again in the
+    # direct loop's order, so every backend truncates exactly like it
+    acc = acc.reshape(arr.shape)
+    near = np.nonzero(np.abs(acc - np.rint(acc)) < float_noise_margin)
+    if len(near[0]):
+        pad_y, pad_x = kernel_padding(kernel)
+        padded = pad_edges(arr, pad_y, pad_x, dtype=np.float64)
+        ys, xs = near[0] + pad_y[0], near[1] + pad_x[0]
+        exact = np.zeros(len(ys), dtype=np.float64)
+        for mult, dx, dy in create_ds_kernel([list(row) for row in kernel]):
+            if mult != 0:
+                exact += mult * padded[(ys + dy, xs + dx) + near[2:]]
+        acc[near] = exact
+    return np.clip(acc, 0, 255).astype(np.uint8)
+
+def separate_kernel(kernel, tolerance):
+    k = np.asarray(kernel, dtype=np.float64)
+    if k.shape[0] < 2 or k.shape[1] < 2:
+        return None
+    singular_values = np.linalg.svd(k, compute_uv=False)
+    if singular_values[0] == 0 or singular_values[1] > tolerance * singular_values[0]:
+        return None
+    # factor through the largest entry instead of the SVD vectors so that
+    # e.g. the mean kernel splits into exact [1/9, 1/9, 1/9] x [1, 1, 1]
+    py, px = np.unravel_index(np.argmax(np.abs(k)), k.shape)
+    return k[:, px] / k[py, px], k[py, :]
+
+def convolve_separable(arr, kernel, column, row):
+    pad_y, pad_x = kernel_padding(kernel)
+    height, width = arr.shape[0], arr.shape[1]
+
+    padded = pad_edges(arr, (0, 0), pad_x, dtype=np.float64)
+    horizontal = np.zeros(arr.shape, dtype=np.float64)
+    for j, mult in enumerate(row):
+        if mult != 0:
+            horizontal += mult * padded[:, j:j + width]
+
+    padded = pad_edges(horizontal, pad_y, (0, 0))
+    del horizontal
+    acc = np.zeros(arr.shape, dtype=np.float64)
+    for i, mult in enumerate(column):
+        if mult != 0:
+            acc += mult * padded[i:i + height]
+
+    return truncate_like_direct(acc, arr, kernel)
+
+
+def fast_fft_length(n):
+    # smallest 2^a 3^b 5^c >= n, pocketfft is quickest on those
+    best = 1 << (n - 1).bit_length()
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            length = p35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def convolve_fft(arr, kernel):
+    pad_y, pad_x = kernel_padding(kernel)
+    height, width = arr.shape[0], arr.shape[1]
+    padded = pad_edges(arr, pad_y, pad_x, dtype=np.float64)
+    if padded.ndim == 2:
+        padded = padded[:, :, None]
+    shape = (fast_fft_length(padded.shape[0]), fast_fft_length(padded.shape[1]))
+
+    # correlation, like the direct path: multiply by the conjugate kernel spectrum
+    kernel_spectrum = np.conj(np.fft.rfft2(np.asarray(kernel, dtype=np.float64), s=shape))
+    spectrum = np.fft.rfft2(padded, s=shape, axes=(0, 1))
+    del padded
+    spectrum *= kernel_spectrum[:, :, None]
+    acc = np.fft.irfft2(spectrum, s=shape, axes=(0, 1))[:height, :width]
+
+    return truncate_like_direct(acc, arr, kernel)
+
+def prefers_fft(taps, arr):
+    return taps > fft_crossover_ratio * np.log2(max(arr.shape[0] * arr.shape[1], 2))
+
+def apply_kernel(arr, kernel):
+    factors = separate_kernel(kernel, separable_kernel_tolerance)
+    if factors:
+        taps = np.count_nonzero(factors[0]) + np.count_nonzero(factors[1])
+    else:
+        taps = np.count_nonzero(kernel)
+    if prefers_fft(taps, arr):
+        return convolve_fft(arr, kernel)
+    if factors:
+        return convolve_separable(arr, kernel, *factors)
+    return convolve(arr, kernel)
+
+def median_partition(arr, radius):
+    size = 2 * radius + 1
+    kth = size * size // 2
+    padded = pad_edges(arr, (radius, radius), (radius, radius))
+    out = np.empty_like(arr)
+
+    # every window gets copied out for np.partition, so go in bands of rows
+    rows = max(1, median_band_elements // (arr[0].size * size * size))
+    for y0 in range(0, arr.shape[0], rows):
+        y1 = min(arr.shape[0], y0 + rows)
+        windows = sliding_window_view(padded[y0:y1 + 2 * radius], (size, size), axis=(0, 1))
+        windows = windows.reshape(windows.shape[:-2] + (-1,))
+        out[y0:y1] = np.partition(windows, kth, axis=-1)[..., kth]
+    return out
+
+def median_histogram(arr, radius):
+    # column histograms slide down one row at a time, the window histogram of
+    # every pixel in a row comes from a cumulative sum over columns, so the
+    # cost per pixel does not depend on the radius
+    size = 2 * radius + 1
+    half = size * size // 2
+    count_type = np.uint16 if size * size < 1 << 16 else np.uint32
+    arr3 = arr if arr.ndim == 3 else arr[:, :, None]
+    height, width, channels = arr3.shape
+
+    padded = pad_edges(arr3, (radius, radius), (radius, radius)).transpose(0, 2, 1).copy()
+    padded_width = padded.shape[2]
+    # column 0 stays empty so window sums are a plain difference of the cumsum
+    columns = np.zeros((channels, 256, padded_width + 1), dtype=count_type)
+    cumulative = np.empty_like(columns)
+    ch = np.arange(channels)[:, None]
+    col = np.arange(1, padded_width + 1)[None, :]
+    xs = np.arange(width)[None, :]
+    for y in range(size):
+        columns[ch, padded[y], col] += 1
+
+    out = np.empty((height, channels, width), dtype=np.uint8)
+    for y in range(height):
+        if y:
+            columns[ch, padded[y - 1], col] -= 1
+            columns[ch, padded[y + size - 1], col] += 1
+        np.cumsum(columns, axis=2, out=cumulative)
+        window = (cumulative[:, :, size:] - cumulative[:, :, :-size]).reshape(channels, 16, 16, width)
+
+        coarse = window.sum(axis=2, dtype=count_type)
+        coarse_cdf = np.cumsum(coarse, axis=1)
+        coarse_bin = np.argmax(coarse_cdf > half, axis=1)
+        below = (np.take_along_axis(coarse_cdf, coarse_bin[:, None], 1) - np.take_along_axis(coarse, coarse_bin[:, None], 1))[:, 0]
+        fine_cdf = np.cumsum(window[ch, coarse_bin, :, xs], axis=2) + below[:, :, None]
+        out[y] = coarse_bin * 16 + np.argmax(fine_cdf > half, axis=2)
+
+    return out.transpose(0, 2, 1).reshape(arr.shape)
+
+def median_filter(arr, radius=1):
+    if arr.dtype == np.uint8 and radius >= median_histogram_min_radius:
+        return median_histogram(arr, radius)
+    return median_partition(arr, radius)
+
+def sobel(arr, output="L1"):
+    padded = pad_edges(arr, (1, 1), (1, 1), dtype=np.float32)
+    height, width = arr.shape[0], arr.shape[1]
+    top, middle, bottom = padded[:height], padded[1:height + 1], padded[2:]
+
+    gx = top[:, 2:] - top[:, :width]
+    gx += 2 * (middle[:, 2:] - middle[:, :width])
+    gx += bottom[:, 2:] - bottom[:, :width]
+    gy = bottom[:, :width] + 2 * bottom[:, 1:width + 1] + bottom[:, 2:]
+    gy -= top[:, :width] + 2 * top[:, 1:width + 1] + top[:, 2:]
+
+    if output == "L2":
+        return np.hypot(gx, gy)
+    if output == "direction":
+        return np.arctan2(gy, gx)
+    return np.abs(gx) + np.abs(gy)
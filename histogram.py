@@ -0,0 +1,128 @@
+import numpy as np
+
+levels = np.arange(256)
+
+def luminance(arr):
+    if arr.ndim == 3 and arr.shape[2] == 3:
+        arr = 0.299 * arr[:, :, 0] + 0.587 * arr[:, :, 1] + 0.114 * arr[:, :, 2]
+    if arr.ndim == 3:
+        arr = arr[:, :, 0]
+    return arr.astype(np.uint8)
+
+def histogram(gray):
+    return np.bincount(gray.ravel(), minlength=256)
+
+def threshold_lut(threshold):
+    return np.where(levels >= threshold, 255, 0).astype(np.uint8)
+
+def linear_scaling_lut(factor):
+    return np.minimum(levels * factor, 255).astype(np.uint8)
+
+def percent_black_threshold(hist, black_percent):
+    num_black_pixels = int(hist.sum() * black_percent / 100)
+    # first level whose count of darker pixels reaches the requested amount
+    return int(np.searchsorted(np.cumsum(hist), num_black_pixels)) + 1
+
+def mean_iterative_threshold(hist):
+    total = hist.sum()
+    old_mean = 768
+    new_mean = hist @ levels / total
+    while np.abs(new_mean - old_mean) > 2:
+        old_mean = new_mean
+        darker = levels < old_mean
+        num_darker = hist[darker].sum()
+        if num_darker == 0 or num_darker == total:
+            break
+        mean_darker = hist[darker] @ levels[darker] / num_darker
+        mean_brighter = hist[~darker] @ levels[~darker] / (total - num_darker)
+        new_mean = (mean_darker + mean_brighter) / 2
+    return new_mean
+
+def otsu_threshold(hist):
+    # threshold t splits the levels into < t and >= t, like threshold_lut
+    weight_dark = np.cumsum(hist)[:-1].astype(np.float64)
+    weight_bright = hist.sum() - weight_dark
+    sum_dark = np.cumsum(hist * levels)[:-1].astype(np.float64)
+    sum_bright = hist @ levels - sum_dark
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = weight_dark * weight_bright * (sum_dark / weight_dark - sum_bright / weight_bright) ** 2
+    return int(np.argmax(np.nan_to_num(between))) + 1
+
+def stretch_lut(hist):
+    present = np.flatnonzero(hist)
+    low, high = present[0], present[-1]
+    if high == low:
+        return levels.astype(np.uint8)
+    return ((levels - low) / (high - low) * 255).clip(0, 255).astype(np.uint8)
+
+def equalize_lut(hist):
+    return (np.cumsum(hist) / hist.sum() * 255).astype(np.uint8)
+
+def tile_weights(length, tiles):
+    # neighbouring tile centres and the weight of the second one for every pixel
+    tile_size = -(-length // tiles)
+    position = (np.arange(length) - (tile_size - 1) / 2) / tile_size
+    first = np.clip(np.floor(position).astype(int), 0, tiles - 1)
+    second = np.minimum(first + 1, tiles - 1)
+    weight = np.clip(position - first, 0, 1).astype(np.float32)
+    return tile_size, first, second, weight
+
+def clahe_grid(height, width, tiles=8):
+    # cell height and width and the number of cells down and across
+    tile_h, tile_w = -(-height // min(tiles, height)), -(-width // min(tiles, width))
+    return tile_h, tile_w, -(-height // tile_h), -(-width // tile_w)
+
+def clahe_histograms(gray, grid, y0=0, x0=0):
+    # histograms of the grid cells gray covers, it starts at (y0, x0) of the image
+    tile_h, tile_w, tiles_y, tiles_x = grid
+    rows = np.arange(y0, y0 + gray.shape[0]) // tile_h
+    cols = np.arange(x0, x0 + gray.shape[1]) // tile_w
+    tile_index = rows[:, None] * tiles_x + cols[None, :]
+    hists = np.bincount((tile_index * 256 + gray).ravel(), minlength=tiles_y * tiles_x * 256)
+    return hists.reshape(tiles_y, tiles_x, 256)
+
+def clahe_luts(hists, clip_limit=2.0):
+    hists = hists.astype(np.float32)
+    counts = hists.sum(axis=2, keepdims=True)
+    limit = np.maximum(clip_limit * counts / 256, 1)
+    excess = np.maximum(hists - limit, 0).sum(axis=2, keepdims=True)
+    return np.cumsum(np.minimum(hists, limit) + excess / 256, axis=2) / counts * 255
+
+def clahe_map(gray, luts, height, width, y0=0, x0=0):
+    # gray is the part of a height x width image starting at (y0, x0)
+    tiles_y, tiles_x = luts.shape[:2]
+    _, ty0, ty1, wy = tile_weights(height, min(luts.shape[0], height))
+    _, tx0, tx1, wx = tile_weights(width, min(luts.shape[1], width))
+    rows, cols = slice(y0, y0 + gray.shape[0]), slice(x0, x0 + gray.shape[1])
+    ty0, ty1, wy = np.minimum(ty0[rows], tiles_y - 1), np.minimum(ty1[rows], tiles_y - 1), wy[rows]
+    tx0, tx1, wx = np.minimum(tx0[cols], tiles_x - 1), np.minimum(tx1[cols], tiles_x - 1), wx[cols]
+
+    wy, wx = wy[:, None], wx[None, :]
+    top = (1 - wx) * luts[ty0[:, None], tx0[None, :], gray] + wx * luts[ty0[:, None], tx1[None, :], gray]
+    bottom = (1 - wx) * luts[ty1[:, None], tx0[None, :], gray] + wx * luts[ty1[:, None], tx1[None, :], gray]
+    return ((1 - wy) * top + wy * bottom).clip(0, 255).astype(np.uint8)
+
+def clahe(gray, tiles=8, clip_limit=2.0):
+    height, width = gray.shape
+    luts = clahe_luts(clahe_histograms(gray, clahe_grid(height, width, tiles)), clip_limit)
+    return clahe_map(gray, luts, height, width)
+
+def float_luminance(arr):
+    return np.float32(0.299) * arr[:, :, 0] + np.float32(0.587) * arr[:, :, 1] + np.float32(0.114) * arr[:, :, 2]
+
+def stretch_float(y, y_range=None):
+    # y_range is the (min, max) luminance of the whole image when y is a part of it
+    low, high = (y.min(), y.max()) if y_range is None else y_range
+    if high == low:
+        return y
+    return (y - low) * np.float32(255 / (high - low))
+
+def replace_luminance(arr, new_y, y=None):
+    if arr.shape[2] == 1:
+        return new_y[:, :, None]
+    # Cb and Cr stay put, so in RGB the luminance change is added to every channel
+    delta = new_y - (float_luminance(arr) if y is None else y)
+    out = np.empty_like(arr)
+    for channel in range(3):
+        out[:, :, channel] = (arr[:, :, channel] + delta).clip(0, 255)
+    return out
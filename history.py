@@ -0,0 +1,84 @@
+import zlib
+from collections import deque
+
+import numpy as np
+
+from tiled_image import TiledImage
+
+def broadcast_channels(region, channels):
+    # gray images repeat their channel, so the first one gives them back
+    return np.broadcast_to(region, region.shape[:2] + (channels,))
+
+def tile_delta(before, after, compression=1, tiles=None):
+    # only the changed tiles, xor-ed with what they were: the same delta turns
+    # either version into the other one; tiles limits the search when the
+    # caller knows where the two can differ
+    channels = max(before.pixels.shape[2], after.pixels.shape[2])
+    delta = {}
+    for y0, y1, x0, x1 in after.tiles() if tiles is None else tiles:
+        old = broadcast_channels(before.pixels[y0:y1, x0:x1], channels)
+        new = broadcast_channels(after.pixels[y0:y1, x0:x1], channels)
+        if not np.array_equal(old, new):
+            delta[y0, y1, x0, x1] = zlib.compress(np.bitwise_xor(old, new), compression)
+    return delta
+
+def apply_delta(src, delta, channels, in_memory=False, base=None, tiles=None):
+    # with a base the result is a copy of it on write and only the given
+    # tiles, the ones it differs from base in, are written
+    work_channels = max(channels, src.pixels.shape[2])
+    if base is None:
+        dst, tiles = TiledImage.create(src.height, src.width, channels, in_memory), src.tiles()
+    else:
+        dst = base.copy_on_write()
+        dst.patched_tiles.update(tiles)
+    for y0, y1, x0, x1 in tiles:
+        region = broadcast_channels(src.pixels[y0:y1, x0:x1], work_channels)
+        if (data := delta.get((y0, y1, x0, x1))) is not None:
+            region = region ^ np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(region.shape)
+        dst.pixels[y0:y1, x0:x1] = region[:, :, :channels]
+    return dst
+
+class EditStep:
+    def __init__(self, delta, channels_before, channels_after, state_before, state_after):
+        self.delta = delta
+        self.channels_before = channels_before
+        self.channels_after = channels_after
+        self.state_before = state_before
+        self.state_after = state_after
+        self.nbytes = sum(len(data) for data in delta.values())
+
+class EditHistory:
+    # steps keep compressed tile deltas instead of snapshots, all of them
+    # together stay under budget bytes by forgetting the oldest ones first
+    def __init__(self, budget, compression=1):
+        self.budget = budget
+        self.compression = compression
+        self.clear()
+
+    def clear(self, state=None):
+        self.undo_steps = deque()
+        self.redo_steps = []
+        self.nbytes = 0
+        # whatever goes along with the current pixels, handed back on undo and redo
+        self.state = state
+
+    def record(self, delta, channels_before, channels_after, state):
+        for step in self.redo_steps:
+            self.nbytes -= step.nbytes
+        self.redo_steps = []
+        step = EditStep(delta, channels_before, channels_after, self.state, state)
+        self.undo_steps.append(step)
+        self.nbytes += step.nbytes
+        self.state = state
+        while self.nbytes > self.budget and self.undo_steps:
+            self.nbytes -= self.undo_steps.popleft().nbytes
+
+    def undo(self):
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        self.state = step.state_before
+
+    def redo(self):
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        self.state = step.state_after
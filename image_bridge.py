@@ -0,0 +1,40 @@
+import numpy as np
+from PySide6.QtGui import QImage
+
+# bytes per pixel, byte offset of the red (or gray) channel, step to the next channel, channels
+channel_layouts = {
+    QImage.Format_Grayscale8: (1, 0, 1, 1),
+    QImage.Format_RGB888: (3, 0, 1, 3),
+    QImage.Format_RGBX8888: (4, 0, 1, 3),
+    QImage.Format_RGBA8888: (4, 0, 1, 3),
+    # 0xAARRGGBB words, stored as B, G, R, A on little-endian machines
+    QImage.Format_RGB32: (4, 2, -1, 3),
+    QImage.Format_ARGB32: (4, 2, -1, 3),
+    QImage.Format_ARGB32_Premultiplied: (4, 2, -1, 3),
+}
+
+class QImageBuffer:
+    # numpy views keep this object as their base, and it keeps the QImage
+    # (and so the pixel buffer) alive for as long as any view exists
+    def __init__(self, image, shape, strides, offset):
+        self.image = image
+        address = np.frombuffer(image.constBits(), dtype=np.uint8).ctypes.data + offset
+        self.__array_interface__ = {
+            "shape": shape, "typestr": "|u1", "data": (address, True), "strides": strides, "version": 3
+        }
+
+def qimage_to_array(image):
+    if image.format() not in channel_layouts:
+        image = image.convertToFormat(QImage.Format_RGB32)
+    bytes_per_pixel, offset, step, channels = channel_layouts[image.format()]
+    shape = (image.height(), image.width(), channels)
+    strides = (image.bytesPerLine(), bytes_per_pixel, step)
+    return np.asarray(QImageBuffer(image, shape, strides, offset))
+
+def array_to_qimage(arr):
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    arr = np.ascontiguousarray(arr, dtype=np.uint8)
+    end_format = QImage.Format_Grayscale8 if arr.shape[2] == 1 else QImage.Format_RGB888
+    # QImage holds a reference to the array instead of copying it
+    return QImage(arr, arr.shape[1], arr.shape[0], arr.strides[0], end_format)
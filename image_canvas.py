@@ -1,23 +1,77 @@
+import os
+import math
+from collections import OrderedDict
+
 from PySide6.QtWidgets import QWidget
-from PySide6.QtGui import QImage, QPainter, QColor
-from PySide6.QtCore import Qt, QPoint, QEvent, Signal
+from PySide6.QtGui import QImage, QPainter, QColor, QPen
+from PySide6.QtCore import Qt, QPoint, QRectF, QEvent, Signal, QTimer, QThreadPool
 
-from load_ppm_jpg import load_ppm
+from load_ppm_jpg import load_ppm, save_ppm, map_ppm, process_ppm_stream
+from image_bridge import qimage_to_array, array_to_qimage
 import numpy as np
-from utils import create_ds_kernel
-
-ds = [(-1,-1),(0,-1),(1,-1),(-1,0),(0,0),(1,0),(-1,1),(0,1),(1,1)]
+from histogram import luminance, histogram, linear_scaling_lut
+from constants import (
+    scaling_debounce_ms, tiled_image_min_bytes, tile_size, tiled_overview_size, tile_cache_tiles,
+    pipeline_cache_bytes, result_cache_dir, result_cache_disk_bytes, result_cache_compression, progressive_min_ratio,
+    roi_halo_step, history_bytes, history_compression
+)
+from processing import apply_filter, scale_filter_params, filter_halo, expand_roi, paste_roi
+from tiled_image import TiledImage, map_tiles, filter_tiled, filter_statistics
+from parallel import parallel_filter
+from filter_worker import FilterTask
+from pipeline import FilterPipeline, pixels_digest
+from history import EditHistory, tile_delta, apply_delta
 
 class ImageCanvas(QWidget):
     hover_over_color = Signal(int, int, int)
+    filter_progress = Signal(int)
+    filter_running = Signal(bool)
+    filter_failed = Signal(str)
+    pipeline_changed = Signal(list, int)
+    history_changed = Signal(bool, bool)
+    stream_finished = Signal(int)
     def __init__(self, parent=None):
         super().__init__()
+        self.thread_pool = QThreadPool(self)
+        self.filter_request = 0
+        self.filter_task = None
+        # set while the task restores an undo step, further presses are counted
+        self.restoring = False
+        self.queued_steps = 0
+        self.pipeline = FilterPipeline(pipeline_cache_bytes, result_cache_dir, result_cache_disk_bytes, result_cache_compression)
+        self.digest_cache = None
+        self.history = EditHistory(history_bytes, history_compression)
+        # the pixels that go with the history's current state, what is shown
+        # can be ahead of them while a slider is being dragged
+        self.history_pixels = None
+        # False while what is shown is such a slider preview
+        self.showing_history = True
         self.image = None
         self.modified_image = None
-        self.scaled = None
+        self.tiled_image = None
+        self.tiled_key = None
+        self.tiled_result = None
+        self.tile_cache = OrderedDict()
+        self.image_version = 0
+        self.luminance_cache = None
+        self.statistics_cache = None
+        self.preview_image = None
+        self.pending_scaling = None
+        self.scaling_preview = False
+        self.display_proxy_cache = None
+        self.scaling_timer = QTimer(self)
+        self.scaling_timer.setSingleShot(True)
+        self.scaling_timer.setInterval(scaling_debounce_ms)
+        self.scaling_timer.timeout.connect(self.render_lin_scaling)
+        self.pyramid = None
+        self.fit = None
         self.scale = 1.0
         self.offset = QPoint(0, 0)
         self.last_mouse_pos = None
+        # selected region as (y0, y1, x0, x1) in full resolution pixels
+        self.roi = None
+        self.roi_drag = None
+        self.full_fit = None
         self.x = None
         self.y = None
         self.setMouseTracking(True)
@@ -26,56 +80,256 @@ class ImageCanvas(QWidget):
         painter = QPainter(self)
         painter.translate(self.offset)
         painter.scale(self.scale, self.scale)
-        current_image = self.modified_image if self.modified_image else self.image
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        current_image = self.preview_image or self.modified_image or self.image
         if current_image:
-            self.scaled = current_image.scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.x = (self.width() - self.scaled.width()) / 2
-            self.y = (self.height() - self.scaled.height()) / 2
-            painter.drawImage(self.x, self.y, self.scaled)
+            self.fit = min(self.width() / current_image.width(), self.height() / current_image.height())
+            self.x = (self.width() - current_image.width() * self.fit) / 2
+            self.y = (self.height() - current_image.height() * self.fit) / 2
+            self.full_fit = self.fit * current_image.width() / self.full_size()[0]
+            self.paint_visible(painter, current_image)
+            if self.tiled_image and self.preview_image is None:
+                self.paint_tiles(painter, self.tiled_result or self.tiled_image)
+            if roi := self.drag_roi() or self.roi:
+                y0, y1, x0, x1 = roi
+                painter.setPen(QPen(Qt.yellow, 0, Qt.DashLine))
+                painter.drawRect(QRectF(self.x + x0 * self.full_fit, self.y + y0 * self.full_fit,
+                                        (x1 - x0) * self.full_fit, (y1 - y0) * self.full_fit))
+
+    def full_size(self):
+        if self.tiled_image:
+            return self.tiled_image.width, self.tiled_image.height
+        return self.image.width(), self.image.height()
+
+    def image_position(self, pos):
+        x = (((pos.x() - self.offset.x()) / self.scale) - self.x) / self.full_fit
+        y = (((pos.y() - self.offset.y()) / self.scale) - self.y) / self.full_fit
+        return x, y
+
+    def drag_roi(self):
+        if not self.roi_drag:
+            return None
+        (ax, ay), (bx, by) = self.roi_drag
+        width, height = self.full_size()
+        x0, x1 = sorted(min(max(round(v), 0), width) for v in (ax, bx))
+        y0, y1 = sorted(min(max(round(v), 0), height) for v in (ay, by))
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return y0, y1, x0, x1
+
+    def set_roi(self, roi):
+        self.roi = roi
+        self.update()
+        if self.pipeline.stages:
+            self.run_pipeline()
+
+    def visible_rect(self, fit):
+        # widget corners in the coordinates of an image drawn with `fit` screen pixels per pixel
+        left = (-self.offset.x() / self.scale - self.x) / fit
+        top = (-self.offset.y() / self.scale - self.y) / fit
+        return left, top, left + self.width() / self.scale / fit, top + self.height() / self.scale / fit
+
+    def pyramid_level(self, image, zoom):
+        # halved copies of the image, built on first use and dropped as soon as
+        # a different image is displayed; the coarsest level that still has a
+        # pixel for every screen pixel is used
+        if self.pyramid is None or self.pyramid[0] is not image:
+            self.pyramid = [image]
+        level = 0
+        while zoom * 2 ** (level + 1) <= 1 and min(self.pyramid[level].width(), self.pyramid[level].height()) > 1:
+            level += 1
+            if level == len(self.pyramid):
+                previous = self.pyramid[-1]
+                self.pyramid.append(previous.scaled(max(1, previous.width() // 2), max(1, previous.height() // 2),
+                                                    Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+        return self.pyramid[level]
+
+    def paint_visible(self, painter, image):
+        level = self.pyramid_level(image, self.fit * self.scale)
+        ratio_x, ratio_y = level.width() / image.width(), level.height() / image.height()
+        left, top, right, bottom = self.visible_rect(self.fit)
+        left, top = max(0, math.floor(left * ratio_x)), max(0, math.floor(top * ratio_y))
+        right, bottom = min(level.width(), math.ceil(right * ratio_x)), min(level.height(), math.ceil(bottom * ratio_y))
+        if right <= left or bottom <= top:
+            return
+        target = QRectF(self.x + left / ratio_x * self.fit, self.y + top / ratio_y * self.fit,
+                        (right - left) / ratio_x * self.fit, (bottom - top) / ratio_y * self.fit)
+        painter.drawImage(target, level, QRectF(left, top, right - left, bottom - top))
+
+    def paint_tiles(self, painter, tiled):
+        # only tiles under the widget are paged in, sampled at about one image
+        # pixel per screen pixel; the tile grid is aligned to the sampling step
+        # so neighbouring tiles meet without seams
+        fit = self.full_fit
+        step = max(1, int(1 / (fit * self.scale)))
+        span = tile_size * step
+        left, top, right, bottom = self.visible_rect(fit)
+        for ty in range(max(0, int(top // span)), min(-(-tiled.height // span), int(bottom // span) + 1)):
+            for tx in range(max(0, int(left // span)), min(-(-tiled.width // span), int(right // span) + 1)):
+                tile = self.display_tile(tiled, step, ty, tx)
+                target = QRectF(self.x + tx * span * fit, self.y + ty * span * fit, tile.width() * step * fit, tile.height() * step * fit)
+                painter.drawImage(target, tile)
+
+    def display_tile(self, tiled, step, ty, tx):
+        key = (step, ty, tx)
+        if key in self.tile_cache:
+            self.tile_cache.move_to_end(key)
+        else:
+            y0, x0 = ty * tile_size * step, tx * tile_size * step
+            self.tile_cache[key] = array_to_qimage(tiled.sample(step, y0, y0 + tile_size * step, x0, x0 + tile_size * step))
+            if len(self.tile_cache) > tile_cache_tiles:
+                self.tile_cache.popitem(last=False)
+        return self.tile_cache[key]
+
+    def overview_step(self, tiled):
+        return -(-max(tiled.height, tiled.width) // tiled_overview_size)
+
+    def tiled_overview(self, tiled):
+        return array_to_qimage(tiled.sample(self.overview_step(tiled)))
+
+    def patched_overview(self, overview, tiled, regions):
+        # only the regions are sampled again, the rest comes from the old overview
+        step = self.overview_step(tiled)
+        arr = qimage_to_array(overview).copy()
+        for region in regions:
+            y0, y1, x0, x1 = (-(-bound // step) for bound in region)
+            arr[y0:y1, x0:x1] = tiled.sample(step, y0 * step, y1 * step, x0 * step, x1 * step)
+        return array_to_qimage(arr)
+
+    def set_tiled_result(self, tiled, overview=None):
+        self.tiled_result = tiled
+        self.tile_cache.clear()
+        self.modified_image = overview or self.tiled_overview(tiled)
 
     def load_from_file(self, path): 
-        if path.lower().endswith(".ppm"):
+        self.cancel_filter()
+        self.tiled_image = None
+        if path.lower().endswith(".ppm") and os.path.getsize(path) >= tiled_image_min_bytes:
+            self.tiled_image = map_ppm(path)
+        if self.tiled_image:
+            # the QImage is only an overview, filters and saving use the tiles;
+            # hashing the whole file would take long, results are keyed by the
+            # file's identity instead, which also holds across sessions
+            self.image = self.tiled_overview(self.tiled_image)
+            stat = os.stat(path)
+            self.tiled_key = ("tiled", os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        elif path.lower().endswith(".ppm"):
             self.image = load_ppm(path)
         else:
             self.image = QImage(path)
+        self.image_version += 1
+        # the result cache is keyed by content and outlives the image
+        self.pipeline.stages = []
+        self.roi = None
+        self.pipeline_changed.emit([], -1)
+        self.history.clear(self.edit_state(False))
+        self.history_changed.emit(False, False)
+        self.showing_history = True
         self.modified_image = None
+        self.tiled_result = None
+        self.history_pixels = self.current_pixels()
+        self.tile_cache.clear()
+        self.preview_image = None
+        self.pending_scaling = None
+        self.scaling_timer.stop()
         self.scale = 1.0
         self.offset = QPoint(0, 0)
         self.update()
         self.hover_over_color.emit(0, 0, 0)
 
+    def save_to_file(self, path, file_format, quality=80, sixteen_bit=False):
+        image = self.modified_image or self.image
+        if self.tiled_image:
+            if file_format == "JPEG":
+                raise OSError("Images this large can only be saved as PPM")
+            tiled = self.tiled_result or self.tiled_image
+            save_ppm(path, tiled.pixels, binary=file_format == "PPM6", maxval=65535 if sixteen_bit else 255)
+        elif file_format == "JPEG":
+            if not image.save(path, "JPEG", quality):
+                raise OSError(f"Could not write {path}")
+        else:
+            save_ppm(path, qimage_to_array(image), binary=file_format == "PPM6", maxval=65535 if sixteen_bit else 255)
+
     def handle_lin_scaling_updated(self, new_scaling_value):
-        if self.image:
-            self.modified_image = QImage(self.image.width(), self.image.height(), QImage.Format_RGB888)
-            factor = new_scaling_value / 10
-            for y in range(self.image.height()):
-                for x in range(self.image.width()):
-                    color = self.image.pixelColor(x, y)
-                    r = min(int(color.red() * factor), 255)
-                    g = min(int(color.green() * factor), 255)
-                    b = min(int(color.blue() * factor), 255)
-                    self.modified_image.setPixelColor(x, y, QColor(r, g, b))
+        # slider events only record the value, the timer renders the latest one
+        self.pending_scaling = new_scaling_value
+        self.scaling_timer.start()
+
+    def set_scaling_preview(self, enabled):
+        self.scaling_preview = enabled
+        if not enabled and self.pending_scaling is not None:
+            self.scaling_timer.stop()
+            self.render_lin_scaling()
+
+    def display_proxy(self):
+        key = (self.image_version, self.width(), self.height())
+        if self.display_proxy_cache is None or self.display_proxy_cache[0] != key:
+            proxy = self.image
+            if self.image.width() > self.width() or self.image.height() > self.height():
+                proxy = self.image.scaled(self.size(), Qt.KeepAspectRatio, Qt.FastTransformation)
+            self.display_proxy_cache = (key, qimage_to_array(proxy))
+        return self.display_proxy_cache[1]
+
+    def render_lin_scaling(self):
+        if self.image and self.pending_scaling is not None:
+            lut = linear_scaling_lut(self.pending_scaling / 10)
+            if self.scaling_preview:
+                self.preview_image = array_to_qimage(lut[self.display_proxy()])
+            else:
+                self.pending_scaling = None
+                self.scale_in_background(lut)
+                # the widget-sized version stays up until the full one is there
+                self.preview_image = array_to_qimage(lut[self.display_proxy()])
             self.update()
 
+    def scale_in_background(self, lut):
+        self.cancel_filter()
+        tiled, source = self.tiled_image, qimage_to_array(self.image)
+        before, state = self.history_pixels, self.edit_state(True)
+
+        def job(progress, preview):
+            if tiled:
+                result = map_tiles(tiled, lambda region: lut[region], progress=progress)
+                image = self.tiled_overview(result)
+            else:
+                result = TiledImage(lut[source])
+                image = array_to_qimage(result.pixels)
+            delta = tile_delta(before, result, history_compression)
+            return result if tiled else None, image, lambda: self.record_edit(before, result, delta, state)
+
+        self.start_task(job)
+
     def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton:
+        # shift + drag selects the region filters apply to, a plain drag pans
+        if event.button() == Qt.LeftButton and event.modifiers() & Qt.ShiftModifier and self.full_fit:
+            position = self.image_position(event.pos())
+            self.roi_drag = (position, position)
+        elif event.button() == Qt.LeftButton:
             self.last_mouse_pos = event.pos()
 
     def mouseMoveEvent(self, event):
-        if self.last_mouse_pos:
+        if self.roi_drag:
+            self.roi_drag = (self.roi_drag[0], self.image_position(event.pos()))
+            self.update()
+        elif self.last_mouse_pos:
             delta = event.pos() - self.last_mouse_pos
             self.offset += delta
             self.last_mouse_pos = event.pos()
             self.update()
-        if self.image:
-            x = ((event.pos().x() - self.offset.x()) / self.scale) - self.x
-            y = ((event.pos().y() - self.offset.y()) / self.scale) - self.y
-            if x >= 0 and x < self.scaled.width() and y >= 0 and y < self.scaled.height():
-                color = QColor(self.scaled.pixel(x, y))
+        current_image = self.preview_image or self.modified_image or self.image
+        if current_image and self.fit:
+            x = (((event.pos().x() - self.offset.x()) / self.scale) - self.x) / self.fit
+            y = (((event.pos().y() - self.offset.y()) / self.scale) - self.y) / self.fit
+            if x >= 0 and x < current_image.width() and y >= 0 and y < current_image.height():
+                color = QColor(current_image.pixel(int(x), int(y)))
                 self.hover_over_color.emit(color.red(), color.green(), color.blue())
 
     def mouseReleaseEvent(self, event):
         self.last_mouse_pos = None
+        if self.roi_drag:
+            roi = self.drag_roi()
+            self.roi_drag = None
+            self.set_roi(roi)
 
     def event(self, event):
         if event.type() == QEvent.NativeGesture:
@@ -89,248 +343,299 @@ class ImageCanvas(QWidget):
         self.scale *= factor
         self.update()
 
-    def binarize(self, name, bin_threshold, black_percent):
-        if self.image:
-            arr = self.read_image_bits()
-            if arr.ndim == 3 and arr.shape[2] == 3: 
-                arr = 0.299 * arr[:, :, 0] + 0.587 * arr[:, :, 1] + 0.114 * arr[:, :, 2]
-            if arr.ndim == 3:
-                arr = arr[:, : 0]
-            arr = arr.astype(np.uint8)
-            arr_flat = arr.flatten()
-
-            if "percent black" in name:
-                num_pixels = arr_flat.shape[0]
-                num_black_pixels = int(num_pixels * black_percent / 100)
-                cdf = np.zeros(257, dtype=np.uint32)
-                cdf[0] = 0
-                for i in range(1, 257):
-                    cdf[i] = cdf[i - 1] + np.sum(arr_flat == (i - 1))
-                    if cdf[i] >= num_black_pixels:
-                        break
-                arr_flat[arr_flat < i] = 0
-                arr_flat[arr_flat >= i] = 255
-                out = arr_flat.reshape(arr.shape[0], arr.shape[1])              
-                
-            elif "mean iterative" in name:
-                old_mean = 768
-                new_mean = arr_flat.mean()
-                while np.abs(new_mean - old_mean) > 2:
-                    old_mean = new_mean
-                    darker = arr_flat[arr_flat < old_mean]
-                    brighter = arr_flat[arr_flat >= old_mean]
-                    mean_darker = darker.mean()
-                    mean_brighter = brighter.mean()
-                    new_mean = (mean_darker + mean_brighter) / 2
-                out = (arr >= new_mean).astype(np.uint8) * 255
-            else: # threshold
-                out = (arr >= bin_threshold).astype(np.uint8) * 255
-
-            self.modified_image = QImage(out, out.shape[1], out.shape[0], out.shape[1], QImage.Format_Grayscale8).copy()
-            self.update()
+    def current_pixels(self):
+        if self.tiled_image:
+            return self.tiled_result or self.tiled_image
+        return TiledImage(qimage_to_array(self.modified_image or self.image))
 
-    def perform_dilation(self, arr):
-        out = np.zeros_like(arr, dtype=np.uint8)
-        for y in range(arr.shape[0]):
-            for x in range(arr.shape[1]):
-                for dx, dy in ds:
-                    nx = min(max(x+dx,0), arr.shape[1]-1)
-                    ny = min(max(y+dy,0), arr.shape[0]-1)
-                    if arr[ny, nx] == 255:
-                        out[y, x] = 255
-        return out
-    
-    def perform_erosion(self, arr):
-        out = np.ones_like(arr, dtype=np.uint8) * 255
-        for y in range(arr.shape[0]):
-            for x in range(arr.shape[1]):
-                for dx, dy in ds:
-                    nx = min(max(x+dx,0), arr.shape[1]-1)
-                    ny = min(max(y+dy,0), arr.shape[0]-1)
-                    if arr[ny, nx] == 0:
-                        out[y, x] = 0
-        return out
-
-    def perform_median_filter(self, arr):
-        out = np.zeros_like(arr, dtype=np.uint8)
-        
-        for y in range(arr.shape[0]):
-            for x in range(arr.shape[1]):
-                all_neighbors = [[] for _ in range(arr.shape[2])]
-                for dx, dy in ds:
-                    nx = min(max(x+dx,0), arr.shape[1]-1)
-                    ny = min(max(y+dy,0), arr.shape[0]-1)
-                    for i in range(arr.shape[2]):
-                        all_neighbors[i].append(arr[ny, nx, i])
-                for i in range(arr.shape[2]):
-                    all_neighbors[i] = sorted(all_neighbors[i])
-                    out[y, x, i] = all_neighbors[i][4]
-
-        return out
-
-    def perform_sobel(self, arr):
-        out = np.zeros_like(arr, dtype=np.uint8)
-        kernel_gx = [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]
-        kernel_gy = [[-1, -2, -1], [0, 0, 0], [1, 2, 1]]
-        ds_kernel_gx = create_ds_kernel(kernel_gx)
-        ds_kernel_gy = create_ds_kernel(kernel_gy)
-        for y in range(arr.shape[0]):
-            for x in range(arr.shape[1]):
-                acc_x = 0.0
-                acc_y = 0.0
-                for (mult_gx, dx, dy), (mult_gy, _, _) in zip(ds_kernel_gx, ds_kernel_gy):
-                    nx = min(max(x+dx,0), arr.shape[1]-1)
-                    ny = min(max(y+dy,0), arr.shape[0]-1)
-                    acc_x += mult_gx * arr[ny, nx].astype(np.float64)
-                    acc_y += mult_gy * arr[ny, nx].astype(np.float64)
-                out[y, x] = np.clip(np.abs(acc_x) + np.abs(acc_y), 0, 255)
-
-        return out
-    
-    def perform_matching(self, arr, kernel):
-        out = np.zeros_like(arr, dtype=np.uint8)
-        ds_kernel = create_ds_kernel(kernel)
-        pad_up = len(kernel) // 2
-        pad_down = pad_up - 1 if len(kernel) % 2 == 0 else pad_up
-        pad_left = len(kernel) // 2
-        pad_right = pad_left - 1 if len(kernel) % 2 == 0 else pad_left
-        for y in range(pad_up, arr.shape[0] - pad_down):
-            for x in range(pad_left, arr.shape[1] - pad_right):
-                all_matches = []
-                for expected_val, dx, dy in ds_kernel:
-                    nx = x+dx
-                    ny = y+dy
-                    if arr[ny, nx] == expected_val * 255 or arr[ny, nx] == expected_val:
-                        all_matches.append(True)
-                    else:
-                        all_matches.append(False)
-                if all(all_matches):
-                    out[y, x] = 255
-        return out
-    
-    def read_image_bits(self):
-        ptr = self.image.constBits()
-        needs_swap = False
-        bytes_per_pixel = 3
-        real_bytes_per_pixel = 3
-
-        if self.image.format() == QImage.Format_Grayscale8:
-            bytes_per_pixel = 1
-            real_bytes_per_pixel = 1
-        elif self.image.format() != QImage.Format_RGB888:
-            needs_swap = True
-            bytes_per_pixel = 4
-        
-        arr = np.array(ptr, dtype=np.uint8).reshape(self.image.height(), self.image.bytesPerLine())
-
-        arr = arr[:, :self.image.width() * bytes_per_pixel]
-        arr = arr.reshape(self.image.height(), self.image.width(), bytes_per_pixel)[:, :, :real_bytes_per_pixel]
-        if needs_swap:
-            arr = arr[:, :, ::-1]
-
-        return arr
-    
-    def histogram_filter(self, name):
-        if self.image:
-            arr = self.read_image_bits()
-            arr = arr.astype(np.float32)
-            if arr.shape[2] == 3:  # colorful
-                y_channel = 0.299 * arr[:, :, 0] + 0.587 * arr[:, :, 1] + 0.114 * arr[:, :, 2]
-                cb_channel = -0.168736 * arr[:, :, 0] - 0.331264 * arr[:, :, 1] + 0.5 * arr[:, :, 2] + 128
-                cr_channel = 0.5 * arr[:, :, 0] - 0.418688 * arr[:, :, 1] - 0.081312 * arr[:, :, 2] + 128
+    def edit_state(self, has_result, patched_tiles=None):
+        # patched_tiles are set for tiled results that are copies of the source on write
+        return list(self.pipeline.stages), self.roi, has_result, patched_tiles
+
+    def record_edit(self, before, after, delta, state):
+        # e.g. a slider released where it was picked up, or a filter the
+        # result doesn't depend on, leaves nothing to undo
+        if not delta and state[:3] == self.history.state[:3]:
+            return
+        self.history.record(delta, before.pixels.shape[2], after.pixels.shape[2], state)
+        self.history_pixels = after
+        self.history_changed.emit(True, False)
+
+    def undo(self):
+        self.step_history(-1)
+
+    def redo(self):
+        self.step_history(1)
+
+    def step_history(self, direction):
+        # presses while a step is being restored queue up behind it
+        if self.filter_task and self.restoring:
+            self.queued_steps += direction
+            return
+        steps = self.history.undo_steps if direction < 0 else self.history.redo_steps
+        if not steps:
+            return
+        self.cancel_filter()
+        step = steps[-1]
+        channels, state = (step.channels_before, step.state_before) if direction < 0 else (step.channels_after, step.state_after)
+        tiled, current, overview = self.tiled_image, self.history_pixels, self.image
+
+        def job(progress, preview):
+            has_result, patched_tiles = state[2:]
+            if not has_result:
+                result = image = None
+            elif patched_tiles is not None:
+                result = apply_delta(current, step.delta, channels, base=tiled, tiles=patched_tiles)
+                image = self.patched_overview(overview, result, patched_tiles)
             else:
-                y_channel = arr
-
-            if "stretch" in name:
-                y_min, y_max = y_channel.min(), y_channel.max()
-                y_channel = (y_channel - y_min) / (y_max - y_min) * 255
-            else: # equalization
-                y_channel = y_channel.clip(0, 255).astype(np.uint8)
-                flat = y_channel.flatten()
-                hist = np.zeros(256, dtype=int)
-                for pixel in flat:
-                    hist[pixel] += 1
-                
-                cdf = np.zeros(256, dtype=int)
-                cdf[0] = hist[0]
-                for i in range(1, 256):
-                    cdf[i] = cdf[i-1] + hist[i]
-                
-                total_pixels = flat.shape[0]
-                
-                lookup_table = np.zeros(256, dtype=np.uint8)
-                for i in range(256):
-                    lookup_table[i] = ((cdf[i]) / (total_pixels)) * 255
-                
-                y_channel = lookup_table[y_channel]
-
-            if arr.shape[2] == 3:  # colorful
-                r_channel = y_channel + 1.402 * (cr_channel - 128)
-                g_channel = y_channel - 0.344136 * (cb_channel - 128) - 0.714136 * (cr_channel - 128)
-                b_channel = y_channel + 1.772 * (cb_channel - 128)
-                
-                new_image = np.stack([r_channel, g_channel, b_channel], axis=-1).clip(0, 255).astype(np.uint8)
-                self.modified_image = QImage(new_image, new_image.shape[1], new_image.shape[0], new_image.shape[1] * 3, QImage.Format_RGB888).copy()
+                result = apply_delta(current, step.delta, channels, in_memory=not tiled)
+                image = self.tiled_overview(result) if tiled else array_to_qimage(result.pixels)
+            return result if tiled else None, image, lambda: self.finish_step(direction, state)
+
+        self.start_task(job)
+        self.restoring = True
+
+    def finish_step(self, direction, state):
+        if direction < 0:
+            self.history.undo()
+        else:
+            self.history.redo()
+        self.history_pixels = self.current_pixels()
+        stages, self.roi = state[:2]
+        self.pipeline.stages = list(stages)
+        self.pipeline_changed.emit(self.stage_labels(), len(stages) - 1)
+        self.history_changed.emit(bool(self.history.undo_steps), bool(self.history.redo_steps))
+        queued, self.queued_steps = self.queued_steps, 0
+        if queued:
+            direction = 1 if queued > 0 else -1
+            self.step_history(direction)
+            if self.restoring:
+                self.queued_steps = queued - direction
+
+    def luminance_histogram(self, arr, version):
+        # called from filter tasks, the tuple is replaced in one go
+        cache = self.luminance_cache
+        if cache is None or cache[0] != version:
+            gray = luminance(arr)
+            cache = self.luminance_cache = (version, gray, histogram(gray))
+        return cache[1:]
+
+    def source_statistics(self, source, version, filter_type):
+        # whole-image histogram (and luminance range for stretching) that
+        # region runs filter their crop with, gathered in one tile pass
+        key = (version, filter_type == "histo stretch")
+        cache = self.statistics_cache
+        if cache is None or cache[0] != key:
+            cache = self.statistics_cache = (key, filter_statistics(source, filter_type))
+        return cache[1]
+
+    def set_stage(self, index, filter_type, transient=False, **params):
+        self.pipeline.set_stage(index, filter_type, params)
+        self.pipeline_changed.emit(self.stage_labels(), index)
+        self.run_pipeline(transient)
+
+    def remove_stage(self, index):
+        self.pipeline.remove_stage(index)
+        self.pipeline_changed.emit(self.stage_labels(), min(index, len(self.pipeline.stages) - 1))
+        self.run_pipeline()
+
+    def stage_labels(self):
+        return [filter_type for filter_type, _ in self.pipeline.stages]
+
+    def run_pipeline(self, transient=False):
+        # transient runs are only shown: neither cached nor recorded for undo
+        if not self.image:
+            return
+        # the shown result already goes with this chain and region
+        if (not transient and self.filter_task is None and self.showing_history and
+                self.edit_state(True)[:3] == self.history.state[:3]):
+            return
+        # a new request supersedes the running one
+        self.cancel_filter()
+        if not self.pipeline.stages:
+            if self.modified_image:
+                self.clear_in_background()
+            self.update()
+            return
+        tiled, tiled_key = self.tiled_image, self.tiled_key
+        stages = list(self.pipeline.stages)
+        source = tiled or qimage_to_array(self.image)
+        roi = self.roi
+        # the delta for undo is worked out along with the result
+        before = self.history_pixels
+        state = self.edit_state(True)
+        # where the shown image can differ from the source, None for anywhere
+        before_tiles = set() if before is tiled else before.patched_tiles
+        overview = self.image
+        version = self.image_version
+        # the source's luminance is kept, so re-thresholding it is just a lookup
+        source_luminance = tiled is None and roi is None and stages[0][0].startswith(("binarize", "histo"))
+        # later stages only have the region's output to go by
+        source_statistics = roi is not None and (stages[0][0].startswith("binarize") or
+                                                 stages[0][0] in {"histo equalize", "histo stretch"})
+
+        def apply_stage(data, index, filter_type, params, progress):
+            if isinstance(data, TiledImage):
+                return filter_tiled(data, filter_type, progress=progress, **params)
+            if index == 0 and source_luminance:
+                gray, hist = self.luminance_histogram(data, version)
+                out = apply_filter(data, filter_type, gray=gray, hist=hist, **params)
+                if progress:
+                    progress(1, 1)
+                return out.reshape(out.shape[0], out.shape[1], -1)
+            if index == 0 and source_statistics:
+                hist, y_range = self.source_statistics(tiled or TiledImage(source), version, filter_type)
+                return parallel_filter(data, filter_type, hist=hist, y_range=y_range, progress=progress, **params)
+            return parallel_filter(data, filter_type, progress=progress, **params)
+
+        proxy = self.display_proxy()
+        full_width, full_height = self.full_size()
+        if roi or full_width * full_height < progressive_min_ratio * proxy.shape[0] * proxy.shape[1]:
+            proxy = None
+        if roi:
+            # the region plus the context all stages together can reach into,
+            # rounded up so that small changes to the chain keep the cached
+            # crops; a first stage thresholding, equalizing or stretching uses
+            # the whole image's statistics, other filters that need the whole
+            # image see just the region
+            halo = sum(filter_halo(filter_type, **params) or 0 for filter_type, params in stages)
+            halo = -(-halo // roi_halo_step) * roi_halo_step
+            bounds = expand_roi(roi, halo, full_height, full_width)
+
+        def job(progress, preview):
+            # hashing a freshly loaded image takes a while, until that is done
+            # the preview is shown without checking for a cached result
+            source_key = tiled_key if tiled else self.known_digest(version)
+            if proxy is not None and not (source_key and self.pipeline.is_cached(source_key, stages)):
+                # the whole chain on a widget-sized copy first, for feedback
+                # long before the full resolution pass is done
+                factor = proxy.shape[1] / full_width
+                out = proxy
+                for filter_type, params in stages:
+                    out = apply_filter(out, filter_type, **scale_filter_params(params, factor))
+                preview(array_to_qimage(out))
+            source_key = source_key or self.image_digest(source, version)
+            changed, result_state = None, state
+            if roi:
+                y0, y1, x0, x1 = bounds
+                crop = np.array((tiled.pixels if tiled else source)[y0:y1, x0:x1])
+                out = self.pipeline.run(crop, (source_key, bounds), stages, apply_stage, progress, cache=not transient)
+                if tiled:
+                    # outside the region the result is the source's own file
+                    result = tiled.copy_on_write()
+                    result.patched_tiles.update(result.tiles_in(*roi))
+                    paste_roi(result.pixels, out, roi, bounds)
+                    image = self.patched_overview(overview, result, [roi])
+                    if before_tiles is not None:
+                        changed = before_tiles | result.patched_tiles
+                    result_state = state[:3] + (result.patched_tiles,)
+                else:
+                    result = paste_roi(source.copy(), out, roi, bounds)
             else:
-                new_image = y_channel.clip(0, 255).astype(np.uint8)
-                self.modified_image = QImage(new_image, new_image.shape[1], new_image.shape[0], new_image.shape[1], QImage.Format_Grayscale8).copy()
+                result = self.pipeline.run(source, source_key, stages, apply_stage, progress, cache=not transient)
+                if tiled:
+                    image = self.tiled_overview(result)
+            if not tiled:
+                image = array_to_qimage(result)
+                result = TiledImage(result.reshape(result.shape[0], result.shape[1], -1))
+            shown = result if tiled else None
+            if transient:
+                return shown, image, None
+            delta = tile_delta(before, result, history_compression, changed)
+            return shown, image, lambda: self.record_edit(before, result, delta, result_state)
 
+        self.start_task(job)
+
+    def clear_in_background(self):
+        tiled = self.tiled_image
+        source = tiled or TiledImage(qimage_to_array(self.image))
+        before, state = self.history_pixels, self.edit_state(False)
+
+        def job(progress, preview):
+            delta = tile_delta(before, source, history_compression, set() if before is tiled else before.patched_tiles)
+            return None, None, lambda: self.record_edit(before, source, delta, state)
+
+        self.start_task(job)
+
+    def process_stream(self, in_path, out_path, filter_type, params):
+        # shares the progress bar and Cancel button with the filters, so it
+        # supersedes a running filter like any other request
+        self.cancel_filter()
+        job = lambda progress, preview: process_ppm_stream(in_path, out_path, filter_type, progress=progress, **params)
+        self.start_task(job, self.handle_stream_finished)
+
+    def start_task(self, job, finished=None):
+        # job(progress, preview) returns (tiled result, image, commit), commit
+        # (if any) runs here once the result is shown; no result shows the source
+        self.filter_task = FilterTask(self.filter_request, job)
+        self.filter_task.signals.progress.connect(self.handle_filter_progress)
+        self.filter_task.signals.preview.connect(self.handle_filter_preview)
+        self.filter_task.signals.finished.connect(finished or self.handle_filter_finished)
+        self.filter_task.signals.failed.connect(self.handle_filter_failed)
+        self.filter_running.emit(True)
+        self.filter_progress.emit(0)
+        self.thread_pool.start(self.filter_task)
+
+    def image_digest(self, arr, version):
+        if self.digest_cache is None or self.digest_cache[0] != version:
+            self.digest_cache = (version, pixels_digest(arr))
+        return self.digest_cache[1]
+
+    def known_digest(self, version):
+        if self.digest_cache and self.digest_cache[0] == version:
+            return self.digest_cache[1]
+        return None
+
+    def cancel_filter(self):
+        # results of older requests that are still on their way get dropped
+        self.filter_request += 1
+        self.restoring = False
+        self.queued_steps = 0
+        if self.filter_task:
+            self.filter_task.cancel()
+            self.filter_task = None
+            self.preview_image = None
+            self.filter_running.emit(False)
             self.update()
-        
-    def filter(self, filter_type, kernel=None, bin_threshold=None):
-        if self.image:
-            arr = self.read_image_bits()
-            bytes_per_pixel = arr.shape[2]
-            end_format = QImage.Format_Grayscale8 if  bytes_per_pixel == 1 else  QImage.Format_RGB888
-            
-            if filter_type in {"dilation", "erosion", "close", "open", "HoM-thin", "HoM-thicken", "sobel"}:
-                if arr.ndim == 3 and arr.shape[2] == 3: 
-                    arr = 0.299 * arr[:, :, 0] + 0.587 * arr[:, :, 1] + 0.114 * arr[:, :, 2]
-                end_format = QImage.Format_Grayscale8
-
-            if filter_type in {"dilation", "erosion", "close", "open", "HoM-thin", "HoM-thicken"}:
-                arr = (arr > bin_threshold).astype(np.uint8) * 255
-            
-            if filter_type == "dilation":
-                out = self.perform_dilation(arr)
-            elif filter_type == "erosion":
-                out = self.perform_erosion(arr)
-            elif filter_type == "close":
-                out = self.perform_dilation(arr)
-                out = self.perform_erosion(out)
-            elif filter_type == "open":
-                out = self.perform_erosion(arr)
-                out = self.perform_dilation(out)
-            elif filter_type == "HoM-thin":
-                out = self.perform_matching(arr, kernel)
-                out = np.clip(arr - out, 0, 255)
-            elif filter_type == "HoM-thicken":
-                out = self.perform_matching(arr, kernel)
-                out = np.clip(arr + out, 0, 255)
-            elif filter_type == "median":
-                out = self.perform_median_filter(arr)
-            elif filter_type == "sobel":
-                out = self.perform_sobel(arr)
-            else:       
-                if filter_type == "mean":
-                    kernel = [[1/9] * 3 for _ in range(3)]
-                elif filter_type ==  "sharpening":
-                    kernel = [[0, -1, 0], [-1, 5, -1], [0, -1, 0]]
-                elif filter_type == "gaussian":
-                    kernel = [[1, 4, 7, 4, 1], [4, 16, 26, 16, 4], [7, 26, 41, 26, 7], [4, 16, 26, 16, 4], [1, 4, 7, 4, 1]]
-                    kernel = [[el/273 for el in row] for row in kernel]
-
-                out = np.zeros_like(arr, dtype=np.uint8)
-                ds_kernel = create_ds_kernel(kernel)
-
-                for y in range(arr.shape[0]):
-                    for x in range(arr.shape[1]):
-                        acc = np.zeros(bytes_per_pixel)
-                        for mult, dx, dy in ds_kernel:
-                            nx = min(max(x+dx,0), arr.shape[1]-1)
-                            ny = min(max(y+dy,0), arr.shape[0]-1)
-                            acc += mult * arr[ny, nx].astype(np.float64)
-                        out[y, x] = np.clip(acc, 0, 255)
-
-            self.modified_image = QImage(out.data, out.shape[1], out.shape[0], out.shape[1] * (out.shape[2] if out.ndim == 3 else 1), end_format).copy()
+
+    def handle_filter_progress(self, request_id, percent):
+        if request_id == self.filter_request:
+            self.filter_progress.emit(percent)
+
+    def handle_filter_preview(self, request_id, image):
+        if request_id == self.filter_request:
+            self.preview_image = image
+            self.update()
+
+    def handle_filter_finished(self, request_id, result):
+        if request_id != self.filter_request:
+            return
+        self.filter_task = None
+        self.preview_image = None
+        tiled, image, commit = result
+        if tiled:
+            self.set_tiled_result(tiled, image)
+        else:
+            self.modified_image = image
+            self.tiled_result = None
+            self.tile_cache.clear()
+        self.filter_running.emit(False)
+        # only transient results come without a commit
+        self.showing_history = commit is not None
+        if commit:
+            commit()
+        self.update()
+
+    def handle_stream_finished(self, request_id, frames):
+        if request_id == self.filter_request:
+            self.filter_task = None
+            self.filter_running.emit(False)
+            self.stream_finished.emit(frames)
+
+    def handle_filter_failed(self, request_id, message):
+        if request_id == self.filter_request:
+            self.filter_task = None
+            self.preview_image = None
+            self.filter_running.emit(False)
             self.update()
+            self.filter_failed.emit(message)
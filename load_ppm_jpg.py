@@ -1,40 +1,199 @@
-from PySide6.QtGui import QImage, QColor
+import os
+import re
+import tempfile
+
 import numpy as np
 
-def load_ppm(path):
-    with open(path, "rb") as f:
-        magic_num = f.readline().strip()
-        if magic_num not in [b'P3', b'P6']:
-            raise ValueError("Not a valid PPM file")
-        meta_data = []
-        temp = b''
-        while len(meta_data) < 3:
-            next_char = f.read(1)
+from image_bridge import array_to_qimage
+from processing import apply_filter
+from tiled_image import TiledImage, map_tiles
+
+rescale_band_rows = 256
+p3_chunk_bytes = 1 << 20
+write_chunk_bytes = 1 << 22
+ppm_whitespace = [b' ', b'\t', b'\n', b'\r', b'\v', b'\f']
+comment_pattern = re.compile(rb'#[^\n]*')
+
+def read_header(f):
+    magic_num = f.read(2)
+    if magic_num not in [b'P3', b'P6']:
+        raise ValueError("Not a valid PPM file")
+    meta_data = []
+    temp = b''
+    # stops right after the single whitespace character that ends maxval
+    while len(meta_data) < 3:
+        next_char = f.read(1)
+        if not next_char:
+            raise ValueError("Truncated PPM header")
+        if next_char == b'#' or next_char.isspace():
+            if len(temp) > 0:
+                meta_data.append(int(temp))
+                temp = b''
             if next_char == b'#':
-                if len(temp) > 0:
-                    meta_data.append(int(temp))
-                    temp = b''
                 f.readline()
-            elif next_char.isspace():
-                if len(temp) > 0:
-                    meta_data.append(int(temp))
-                    temp = b''
-                    if magic_num == b'P6' and len(meta_data) == 3 and next_char != b'\n':
-                        f.readline()
-            else:
-                temp += next_char
-        actual_values = []
-        if magic_num == b'P3':
-            for line in f:
-                line = line.split(b'#')[0]
-                actual_values.extend(line.split())
-            actual_values = np.array(list(map(int, actual_values)), dtype=np.uint16)
         else:
-            actual_values = np.array(list(f.read()), dtype=np.uint16)
-
-        width, height, maxval = meta_data
-        actual_values = actual_values if maxval == 255 else (actual_values / maxval) * 255
-        actual_values = actual_values.astype(np.uint8)
-        image = QImage(actual_values.tobytes(), width, height, 3 * width, QImage.Format_RGB888)
-        return image.copy()
-        
\ No newline at end of file
+            temp += next_char
+    width, height, maxval = meta_data
+    if width <= 0 or height <= 0 or not 0 < maxval < 65536:
+        raise ValueError("Invalid PPM dimensions or maxval")
+    return magic_num, width, height, maxval
+
+def rescale_to_uint8(values, maxval):
+    if maxval == 255:
+        return np.array(values, dtype=np.uint8)
+    out = np.empty(values.shape, dtype=np.uint8)
+    for y in range(0, values.shape[0], rescale_band_rows):
+        band = values[y:y + rescale_band_rows].astype(np.uint32)
+        out[y:y + rescale_band_rows] = band * 255 // maxval
+    return out
+
+def read_p6(path, offset, width, height, maxval):
+    # samples wider than a byte are big-endian 16-bit words
+    dtype = np.uint8 if maxval < 256 else np.dtype('>u2')
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(height, width, 3))
+
+def split_complete_tokens(chunk):
+    # everything up to the last whitespace outside a comment can be parsed now,
+    # the rest (a cut token or an unterminated comment) waits for the next read
+    cut = max(chunk.rfind(c) for c in ppm_whitespace)
+    last_comment = chunk.rfind(b'#')
+    if last_comment > chunk.rfind(b'\n'):
+        cut = min(cut, last_comment - 1)
+    return chunk[:cut + 1], chunk[cut + 1:]
+
+def locate_token(body, index):
+    tokens = (m for m in re.finditer(rb'#[^\n]*|\S+', body) if not m.group().startswith(b'#'))
+    for i, match in enumerate(tokens):
+        if i == index:
+            return match.start(), match.group()
+
+def read_p3(f, width, height, maxval):
+    count = width * height * 3
+    values = np.empty(count, dtype=np.uint16)
+    filled = 0
+    position = f.tell()
+    pending = b''
+    while True:
+        data = f.read(p3_chunk_bytes)
+        if data:
+            body, pending = split_complete_tokens(pending + data)
+        else:
+            body, pending = pending, b''
+        tokens = comment_pattern.sub(b' ', body).split()
+        if tokens:
+            if filled + len(tokens) > count:
+                offset, _ = locate_token(body, count - filled)
+                raise ValueError(f"Unexpected data after {count} samples at byte offset {position + offset}")
+            try:
+                parsed = np.array(tokens).astype(np.int64)
+                bad = np.flatnonzero((parsed < 0) | (parsed > maxval))
+            except ValueError:
+                bad = [i for i, token in enumerate(tokens) if not token.isdigit()] or [0]
+            if len(bad):
+                offset, token = locate_token(body, bad[0])
+                raise ValueError(f"Invalid sample {token!r} at byte offset {position + offset}")
+            values[filled:filled + len(tokens)] = parsed
+            filled += len(tokens)
+        position += len(body)
+        if not data:
+            break
+    if filled < count:
+        raise ValueError(f"Expected {count} samples, found {filled}")
+    return values.reshape(height, width, 3)
+
+def skip_whitespace(f):
+    while next_char := f.read(1):
+        if not next_char.isspace():
+            f.seek(-1, 1)
+            return True
+    return False
+
+def iter_ppm_frames(f):
+    # netpbm allows several images back to back, only one is held at a time
+    while skip_whitespace(f):
+        magic_num, width, height, maxval = read_header(f)
+        if magic_num == b'P3':  # plain files hold exactly one image
+            yield rescale_to_uint8(read_p3(f, width, height, maxval), maxval)
+            return
+        dtype = np.uint8 if maxval < 256 else np.dtype('>u2')
+        values = np.fromfile(f, dtype=dtype, count=width * height * 3)
+        if values.size < width * height * 3:
+            raise ValueError(f"Truncated frame at byte offset {f.tell()}")
+        yield rescale_to_uint8(values.reshape(height, width, 3), maxval)
+
+def process_ppm_stream(in_path, out_path, filter_type, progress=None, **params):
+    # frames go to a scratch file next to the output, which replaces it only
+    # once the whole stream is through; so the output can even be the input
+    # and a failed or cancelled run leaves no half-written stream behind
+    size, frames = os.path.getsize(in_path), 0
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(out_path)))
+    try:
+        with os.fdopen(fd, "wb") as f, open(in_path, "rb") as src:
+            for frame in iter_ppm_frames(src):
+                write_ppm(f, apply_filter(frame, filter_type, **params))
+                frames += 1
+                if progress:
+                    progress(src.tell(), size)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return frames
+
+def load_ppm(path):
+    with open(path, "rb") as f:
+        magic_num, width, height, maxval = read_header(f)
+        if magic_num == b'P6':
+            values = read_p6(path, f.tell(), width, height, maxval)
+        else:
+            values = read_p3(f, width, height, maxval)
+        return array_to_qimage(rescale_to_uint8(values, maxval))
+
+def map_ppm(path):
+    # P6 payloads are used in place, wider samples get rescaled into a scratch
+    # file tile by tile; plain files have no fixed layout to map
+    with open(path, "rb") as f:
+        magic_num, width, height, maxval = read_header(f)
+        if magic_num != b'P6':
+            return None
+        image = TiledImage(read_p6(path, f.tell(), width, height, maxval))
+    if maxval != 255:
+        image = map_tiles(image, lambda region: rescale_to_uint8(region, maxval))
+    return image
+
+def p3_sample_table(maxval):
+    # every sample as a right-aligned, space-terminated field of the same width,
+    # so a whole band of samples formats with a single lookup
+    digits = len(str(maxval))
+    numbers = np.arange(maxval + 1)
+    table = np.full((maxval + 1, digits + 1), ord(' '), dtype=np.uint8)
+    for k in range(digits):
+        power = 10 ** (digits - 1 - k)
+        shown = (numbers >= power) | (power == 1)
+        table[shown, k] = ord('0') + numbers[shown] // power % 10
+    return table
+
+def write_ppm(f, values, binary=True, maxval=255):
+    height, width = values.shape[0], values.shape[1]
+    values = values.reshape(height, width, -1)  # gray filter results come as 2-D arrays
+    f.write(b"%s\n%d %d\n%d\n" % (b"P6" if binary else b"P3", width, height, maxval))
+    dtype = np.dtype(np.uint8) if maxval < 256 else np.dtype('>u2')
+    table = None if binary else p3_sample_table(maxval)
+    rows = max(1, write_chunk_bytes // (width * 3 * (dtype.itemsize if binary else table.shape[1])))
+
+    for y in range(0, height, rows):
+        band = values[y:y + rows]
+        if band.shape[2] == 1:
+            band = np.repeat(band, 3, axis=2)
+        if maxval != 255:
+            band = band.astype(np.uint32) * maxval // 255
+        if binary:
+            f.write(np.ascontiguousarray(band, dtype=dtype).data)
+        else:
+            text = table[band]
+            text[:, :, 2, -1] = ord('\n')
+            f.write(text.data)
+
+def save_ppm(path, values, binary=True, maxval=255):
+    with open(path, "wb") as f:
+        write_ppm(f, values, binary, maxval)
@@ -2,16 +2,19 @@ import sys
 
 from PySide6.QtWidgets import (
     QApplication, QWidget, QMainWindow, QVBoxLayout, QHBoxLayout, QPushButton,
-    QLineEdit, QComboBox, QFileDialog, QButtonGroup, QTabWidget, QSlider, QLabel, QMessageBox, QTextEdit, QSizePolicy
+    QLineEdit, QComboBox, QFileDialog, QButtonGroup, QTabWidget, QSlider, QLabel, QMessageBox, QTextEdit, QSizePolicy,
+    QSpinBox, QCheckBox, QProgressBar, QListWidget
 )
 
 from PySide6.QtCore import Qt, Slot
+from PySide6.QtGui import QKeySequence
 
 from color_picker import ColorPicker
 from canvas import Canvas
-from constants import slider_style_sheet
+from constants import slider_style_sheet, result_cache_exit_bytes
 from utils import transform_text_to_kernel
 from image_canvas import ImageCanvas
+from processing import gray_morphology_filters
 from polygons_canvas import PolygonsCanvas
 from utils import check_create_params_valid, check_and_create_generic_param, check_and_create_point, check_and_create_translate_params
 
@@ -128,6 +131,24 @@ class MainWindow(QMainWindow):
         save_btn = QPushButton("Save")
         save_btn.clicked.connect(self.save_image_file)
         toolbar.addWidget(save_btn, stretch=True)
+
+        stream_btn = QPushButton("Process stream")
+        stream_btn.clicked.connect(self.process_stream_file)
+        toolbar.addWidget(stream_btn, stretch=True)
+
+        undo_btn = QPushButton("Undo")
+        undo_btn.setShortcut(QKeySequence.Undo)
+        undo_btn.setEnabled(False)
+        undo_btn.clicked.connect(self.image_canvas.undo)
+        toolbar.addWidget(undo_btn, stretch=True)
+
+        redo_btn = QPushButton("Redo")
+        redo_btn.setShortcut(QKeySequence.Redo)
+        redo_btn.setEnabled(False)
+        redo_btn.clicked.connect(self.image_canvas.redo)
+        toolbar.addWidget(redo_btn, stretch=True)
+
+        self.image_canvas.history_changed.connect(lambda can_undo, can_redo: (undo_btn.setEnabled(can_undo), redo_btn.setEnabled(can_redo)))
         
         label = QLabel("Save as: ")
         toolbar.addWidget(label)
@@ -137,6 +158,9 @@ class MainWindow(QMainWindow):
         self.format_combo.currentTextChanged.connect(self.handle_format_changes)
         toolbar.addWidget(self.format_combo)
 
+        self.sixteen_bit_check = QCheckBox("16-bit")
+        toolbar.addWidget(self.sixteen_bit_check)
+
         self.label_compression_level = QLabel("Compression quality: ")
         self.label_compression_level.setVisible(False)
         toolbar.addWidget(self.label_compression_level)
@@ -175,11 +199,35 @@ class MainWindow(QMainWindow):
         self.linear_scaling_slider.setTickInterval(1)
         self.linear_scaling_slider.valueChanged.connect(self.update_linear_scaling_label)
         self.linear_scaling_slider.valueChanged.connect(self.image_canvas.handle_lin_scaling_updated)
+        self.linear_scaling_slider.sliderPressed.connect(lambda: self.image_canvas.set_scaling_preview(True))
+        self.linear_scaling_slider.sliderReleased.connect(lambda: self.image_canvas.set_scaling_preview(False))
         extra_tools.addWidget(self.linear_scaling_slider)
 
         self.hover_over_color_vals = QLabel("0, 0, 0")
         extra_tools.addWidget(self.hover_over_color_vals)
 
+        # regions are selected on the image with shift + drag
+        clear_roi_btn = QPushButton("Clear region")
+        clear_roi_btn.clicked.connect(lambda: self.image_canvas.set_roi(None))
+        extra_tools.addWidget(clear_roi_btn)
+
+        self.filter_progress_bar = QProgressBar()
+        self.filter_progress_bar.setRange(0, 100)
+        self.filter_progress_bar.setFixedWidth(150)
+        self.filter_progress_bar.setVisible(False)
+        self.image_canvas.filter_progress.connect(self.filter_progress_bar.setValue)
+        extra_tools.addWidget(self.filter_progress_bar)
+
+        self.cancel_filter_btn = QPushButton("Cancel")
+        self.cancel_filter_btn.setVisible(False)
+        self.cancel_filter_btn.clicked.connect(self.image_canvas.cancel_filter)
+        extra_tools.addWidget(self.cancel_filter_btn)
+
+        self.image_canvas.filter_running.connect(self.filter_progress_bar.setVisible)
+        self.image_canvas.filter_running.connect(self.cancel_filter_btn.setVisible)
+        self.image_canvas.filter_failed.connect(lambda message: QMessageBox.warning(self, "Error", message))
+        self.image_canvas.stream_finished.connect(lambda frames: QMessageBox.information(self, "Stream", f"Filtered {frames} frames"))
+
         v.addLayout(extra_tools)
 
         filters_toolbar = QHBoxLayout()
@@ -189,7 +237,8 @@ class MainWindow(QMainWindow):
         self.filters_button_group.setExclusive(True)
 
         for button_name in ["mean", "median", "sobel", "sharpening", "gaussian", "conv", "dilation", "erosion", "open", "close", "HoM-thin", "HoM-thicken",
-                            "histo stretch", "histo equalize"]:
+                            "gray dilation", "gray erosion", "gray open", "gray close", "top-hat", "histo stretch", "histo equalize",
+                            "histo CLAHE"]:
             button = QPushButton(button_name)
             button.setCheckable(True)
             button.clicked.connect(lambda checked, filter=button_name : self.filter(filter_type=filter))
@@ -203,6 +252,52 @@ class MainWindow(QMainWindow):
         self.kernel_editor.setPlaceholderText("Edit kernel where applicable...")
         filter_params_layout.addWidget(self.kernel_editor)
 
+        window_section = QVBoxLayout()
+        label = QLabel("Window radius")
+        label.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
+        window_section.addWidget(label)
+
+        self.window_radius = QSpinBox()
+        self.window_radius.setRange(1, 50)
+        self.window_radius.setValue(1)
+        window_section.addWidget(self.window_radius)
+
+        label = QLabel("Sobel output")
+        label.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
+        window_section.addWidget(label)
+
+        self.sobel_output_combo = QComboBox()
+        self.sobel_output_combo.addItems(["L1", "L2", "direction"])
+        window_section.addWidget(self.sobel_output_combo)
+
+        self.hom_converge = QCheckBox("HoM: standard kernels until stable")
+        window_section.addWidget(self.hom_converge)
+        window_section.addStretch(1)
+
+        filter_params_layout.addLayout(window_section)
+
+        pipeline_section = QVBoxLayout()
+        label = QLabel("Pipeline")
+        label.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
+        pipeline_section.addWidget(label)
+
+        self.pipeline_list = QListWidget()
+        self.pipeline_list.setFixedWidth(180)
+        self.pipeline_list.currentRowChanged.connect(self.select_stage)
+        pipeline_section.addWidget(self.pipeline_list)
+
+        # while checked, the next filter click appends a stage instead of replacing the selected one
+        self.add_stage_btn = QPushButton("Add stage")
+        self.add_stage_btn.setCheckable(True)
+        pipeline_section.addWidget(self.add_stage_btn)
+
+        remove_stage_btn = QPushButton("Remove stage")
+        remove_stage_btn.clicked.connect(self.remove_stage)
+        pipeline_section.addWidget(remove_stage_btn)
+
+        self.image_canvas.pipeline_changed.connect(self.show_pipeline)
+        filter_params_layout.addLayout(pipeline_section)
+
         binarization_section = QVBoxLayout()
 
         label = QLabel("Binarization settings")
@@ -220,6 +315,8 @@ class MainWindow(QMainWindow):
         self.binary_threshold.setValue(127)
         self.binary_threshold.setTickInterval(5)
         self.binary_threshold.valueChanged.connect(self.update_binary_threshold_value_peek)
+        self.binary_threshold.valueChanged.connect(self.refresh_binarization)
+        self.binary_threshold.sliderReleased.connect(self.refresh_binarization)
         binary_threshold_slider_layout.addWidget(self.binary_threshold)
 
         self.binary_threshold_value_peek = QLineEdit("127")
@@ -240,6 +337,8 @@ class MainWindow(QMainWindow):
         self.black_percent.setValue(50)
         self.black_percent.setTickInterval(5)
         self.black_percent.valueChanged.connect(self.update_black_percent_value_peek)
+        self.black_percent.valueChanged.connect(self.refresh_binarization)
+        self.black_percent.sliderReleased.connect(self.refresh_binarization)
         black_percent_slider_layout.addWidget(self.black_percent)
 
         self.black_percent_value_peek = QLineEdit("50%")
@@ -249,7 +348,8 @@ class MainWindow(QMainWindow):
 
         binarization_section.addLayout(black_percent_slider_layout)
 
-        for button_name in ["binarize - selected value threshold", "binarize - percent black selection", "binarize - mean iterative selection"]:
+        for button_name in ["binarize - selected value threshold", "binarize - percent black selection", "binarize - mean iterative selection",
+                            "binarize - otsu"]:
             button = QPushButton(button_name)
             button.setCheckable(True)
             button.clicked.connect(lambda checked, filter=button_name : self.filter(filter_type=filter))
@@ -422,16 +522,22 @@ class MainWindow(QMainWindow):
         if not self.image_canvas.image:
             QMessageBox.warning(self, "Error", "Load a file first")
         else:
+            file_format = self.format_combo.currentText()
             file_path, _ = QFileDialog.getSaveFileName(
                 None,
                 "Save Image As",
                 "",
-                "JPEG Files (*.jpg)"
+                "JPEG Files (*.jpg)" if file_format == "JPEG" else "PPM Files (*.ppm)"
             )
             if file_path:
-                self.image_canvas.image.save(file_path, quality=self.jpeg_quality_slider.value())
+                try:
+                    self.image_canvas.save_to_file(file_path, file_format, quality=self.jpeg_quality_slider.value(),
+                                                   sixteen_bit=self.sixteen_bit_check.isChecked())
+                except OSError as e:
+                    QMessageBox.warning(self, "File error", f"Could not save the file: {e}")
 
     def handle_format_changes(self, curr_new_text):
+        self.sixteen_bit_check.setVisible(curr_new_text in {"PPM3", "PPM6"})
         if curr_new_text in {"PPM3", "PPM6"}:
             self.label_compression_level.setVisible(False)
             self.text_compression_level.setVisible(False)
@@ -460,26 +566,87 @@ class MainWindow(QMainWindow):
     def update_black_percent_value_peek(self, new_value):
         self.black_percent_value_peek.setText(f"{new_value}%")
 
-    def filter(self, filter_type):
-        selected_bin_threshold = self.binary_threshold.value()
-        black_percent = self.black_percent.value()
-        if filter_type.startswith("binarize"):
-            self.image_canvas.binarize(filter_type, selected_bin_threshold, black_percent)
-            return
-        if filter_type.startswith("histo"):
-            self.image_canvas.histogram_filter(filter_type)
-            return
-        if filter_type in {"HoM-thin", "HoM-thicken", "conv"}:
-            if kernel := transform_text_to_kernel(self.kernel_editor.toPlainText()):
-                self.image_canvas.filter(filter_type=filter_type, kernel=kernel, bin_threshold=selected_bin_threshold)
-            else:
+    def refresh_binarization(self):
+        button = self.filters_button_group.checkedButton()
+        if button and button.text().startswith("binarize"):
+            # while dragging the result is only shown, letting go keeps it and makes one undo step
+            self.filter(button.text(), transient=self.binary_threshold.isSliderDown() or self.black_percent.isSliderDown())
+
+    def filter_params(self, filter_type):
+        # only what the filter reads, stages are cached by their parameters
+        params = {}
+        if filter_type in {"binarize - selected value threshold", "dilation", "erosion", "open", "close", "HoM-thin", "HoM-thicken"}:
+            params["bin_threshold"] = self.binary_threshold.value()
+        elif filter_type == "binarize - percent black selection":
+            params["black_percent"] = self.black_percent.value()
+        elif filter_type == "median" or filter_type in gray_morphology_filters:
+            params["radius"] = self.window_radius.value()
+        elif filter_type == "sobel":
+            params["sobel_output"] = self.sobel_output_combo.currentText()
+        kernel_text = self.kernel_editor.toPlainText()
+        if filter_type in {"HoM-thin", "HoM-thicken"} and self.hom_converge.isChecked():
+            params["converge"] = True
+        elif filter_type in {"dilation", "erosion", "open", "close"}:
+            if kernel_text.strip():
+                if not (kernel := transform_text_to_kernel(kernel_text)):
+                    QMessageBox.warning(self, "Error", "Invalid structuring element. Double check the value")
+                    return None
+                params["kernel"] = kernel
+        elif filter_type in {"HoM-thin", "HoM-thicken", "conv"}:
+            if not (kernel := transform_text_to_kernel(kernel_text, allow_dont_care=filter_type != "conv")):
                 QMessageBox.warning(self, "Error", "Invalid kernel input. Double check the value")
-        else:
-            self.image_canvas.filter(filter_type=filter_type, bin_threshold=selected_bin_threshold)
+                return None
+            params["kernel"] = kernel
+        return params
 
+    def filter(self, filter_type, transient=False):
+        if (params := self.filter_params(filter_type)) is None:
+            return
+        num_stages = len(self.image_canvas.pipeline.stages)
+        if self.add_stage_btn.isChecked() or num_stages == 0:
+            self.add_stage_btn.setChecked(False)
+            index = num_stages
+        else:
+            index = self.pipeline_list.currentRow() if self.pipeline_list.currentRow() >= 0 else num_stages - 1
+        self.image_canvas.set_stage(index, filter_type, transient, **params)
+
+    def remove_stage(self):
+        if self.pipeline_list.currentRow() >= 0:
+            self.image_canvas.remove_stage(self.pipeline_list.currentRow())
+
+    def show_pipeline(self, labels, selected):
+        self.pipeline_list.blockSignals(True)
+        self.pipeline_list.clear()
+        self.pipeline_list.addItems([f"{i + 1}. {label}" for i, label in enumerate(labels)])
+        self.pipeline_list.setCurrentRow(selected)
+        self.pipeline_list.blockSignals(False)
+
+    def select_stage(self, row):
+        # check the stage's filter so the binarization sliders edit that stage
+        if row >= 0:
+            filter_type = self.image_canvas.pipeline.stages[row][0]
+            for button in self.filters_button_group.buttons():
+                if button.text() == filter_type:
+                    button.setChecked(True)
+
+    def process_stream_file(self):
+        button = self.filters_button_group.checkedButton()
+        if not button:
+            QMessageBox.warning(self, "Error", "Select a filter first")
+            return
+        if (params := self.filter_params(button.text())) is None:
+            return
+        in_path, _ = QFileDialog.getOpenFileName(self, 'Open PPM stream', filter='PPM Files (*.ppm)')
+        if not in_path:
+            return
+        out_path, _ = QFileDialog.getSaveFileName(self, 'Save filtered stream', filter='PPM Files (*.ppm)')
+        if not out_path:
+            return
+        self.image_canvas.process_stream(in_path, out_path, button.text(), params)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     w = MainWindow()
+    app.aboutToQuit.connect(lambda: w.image_canvas.pipeline.spill_all(result_cache_exit_bytes))
     w.show()
     sys.exit(app.exec())
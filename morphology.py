@@ -0,0 +1,191 @@
+from collections import deque
+
+import numpy as np
+
+from utils import create_ds_kernel
+from filters import kernel_padding
+
+square_structuring_element = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+
+def structuring_offsets(kernel):
+    kernel = [list(row) for row in (kernel or square_structuring_element)]
+    return [(dx, dy) for val, dx, dy in create_ds_kernel(kernel) if val]
+
+def range_mask(start, stop, num_words):
+    bits = np.zeros(num_words * 64, dtype=bool)
+    bits[start:stop] = True
+    return np.packbits(bits).view(">u8").astype(np.uint64)
+
+def column_bit(words, column):
+    return (words[:, column // 64] >> np.uint64(63 - column % 64)) & np.uint64(1)
+
+def pack_binary(mask, margin_y, margin_x):
+    # 64 pixels per word, leftmost pixel in the most significant bit; the
+    # margins hold edge replicas so shifted reads never need clamping
+    padded = np.pad(mask, ((margin_y, margin_y), (margin_x, margin_x)), mode="edge")
+    packed = np.packbits(padded, axis=1)
+    packed = np.pad(packed, ((0, 0), (0, -packed.shape[1] % 8)))
+    return packed.view(">u8").astype(np.uint64)
+
+def unpack_binary(words, height, width, margin_y, margin_x):
+    packed = words[margin_y:margin_y + height].astype(">u8").view(np.uint8)
+    bits = np.unpackbits(packed, axis=1)[:, margin_x:margin_x + width]
+    return bits * np.uint8(255)
+
+def replicate_packed_edges(words, height, width, margin_y, margin_x):
+    words[:margin_y] = words[margin_y]
+    words[margin_y + height:] = words[margin_y + height - 1]
+    num_words = words.shape[1]
+    for column, start, stop in [(margin_x, 0, margin_x), (margin_x + width - 1, margin_x + width, num_words * 64)]:
+        if start >= stop:
+            continue
+        mask = range_mask(start, stop, num_words)
+        bit = column_bit(words, column).astype(bool)
+        words[bit] |= mask
+        words[~bit] &= ~mask
+
+def shift_packed(words, dx):
+    # result bit at column x holds the source bit at column x + dx
+    if dx == 0:
+        return words
+    num_words = words.shape[1]
+    q, s = divmod(dx, 64)
+
+    def words_from(offset):
+        out = np.zeros_like(words)
+        if offset >= 0 and offset < num_words:
+            out[:, :num_words - offset] = words[:, offset:]
+        elif offset < 0 and -offset < num_words:
+            out[:, -offset:] = words[:, :num_words + offset]
+        return out
+
+    if s == 0:
+        return words_from(q)
+    return (words_from(q) << np.uint64(s)) | (words_from(q + 1) >> np.uint64(64 - s))
+
+def packed_step(words, offsets, height, width, margin_y, margin_x, dilate):
+    acc = np.zeros_like(words[:height]) if dilate else np.full_like(words[:height], ~np.uint64(0))
+    combine = np.bitwise_or if dilate else np.bitwise_and
+    for dx, dy in offsets:
+        rows = words[margin_y + dy:margin_y + dy + height]
+        combine(acc, shift_packed(rows, dx), out=acc)
+
+    out = np.empty_like(words)
+    out[margin_y:margin_y + height] = acc
+    replicate_packed_edges(out, height, width, margin_y, margin_x)
+    return out
+
+def binary_morphology(arr, operations, kernel=None):
+    offsets = structuring_offsets(kernel)
+    margin_y = max([abs(dy) for _, dy in offsets], default=0)
+    margin_x = max([abs(dx) for dx, _ in offsets], default=0)
+    height, width = arr.shape[0], arr.shape[1]
+
+    words = pack_binary(arr.reshape(height, width) == 255, margin_y, margin_x)
+    for operation in operations:
+        words = packed_step(words, offsets, height, width, margin_y, margin_x, operation == "dilation")
+
+    return unpack_binary(words, height, width, margin_y, margin_x).reshape(arr.shape)
+
+def running_extreme(arr, size, axis, func):
+    # van Herk/Gil-Werman: prefix and suffix extremes inside blocks of `size`
+    # samples, every window straddles at most two blocks
+    if size <= 1:
+        return arr
+    arr = np.moveaxis(arr, axis, 0)
+    length = arr.shape[0]
+    before = size // 2
+    after = size - 1 - before + (-(length + size - 1) % size)
+    padded = np.pad(arr, ((before, after),) + ((0, 0),) * (arr.ndim - 1), mode="edge")
+    blocks = padded.reshape((-1, size) + padded.shape[1:])
+
+    prefix = func.accumulate(blocks, axis=1).reshape(padded.shape)
+    suffix = func.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(padded.shape)
+    out = func(suffix[:length], prefix[size - 1:size - 1 + length])
+    return np.moveaxis(out, 0, axis)
+
+def gray_extreme(arr, height, width, func):
+    return running_extreme(running_extreme(arr, width, 1, func), height, 0, func)
+
+def gray_morphology(arr, operation, height, width):
+    if operation == "dilation":
+        return gray_extreme(arr, height, width, np.maximum)
+    if operation == "erosion":
+        return gray_extreme(arr, height, width, np.minimum)
+    if operation == "open":
+        return gray_extreme(gray_extreme(arr, height, width, np.minimum), height, width, np.maximum)
+    if operation == "close":
+        return gray_extreme(gray_extreme(arr, height, width, np.maximum), height, width, np.minimum)
+    if operation == "top-hat":
+        return arr - gray_morphology(arr, "open", height, width)
+    raise ValueError(f"Unknown grayscale morphology operation {operation}")
+
+def matches_expected(values, expected):
+    return (values == expected * 255) | (values == expected)
+
+def hit_or_miss(arr, kernel):
+    (top, bottom), (left, right) = kernel_padding(kernel)
+    taps = [(val, dx, dy) for val, dx, dy in create_ds_kernel([list(row) for row in kernel]) if val is not None]
+    height, width = arr.shape[0] - top - bottom, arr.shape[1] - left - right
+    out = np.zeros_like(arr, dtype=np.uint8)
+    if height <= 0 or width <= 0:
+        return out
+
+    hit = np.ones((height, width) + arr.shape[2:], dtype=bool)
+    for val, dx, dy in taps:
+        hit &= matches_expected(arr[top + dy:top + dy + height, left + dx:left + dx + width], val)
+    out[top:top + height, left:left + width] = hit * np.uint8(255)
+    return out
+
+def rotated_kernels(kernels):
+    rotated = []
+    for turns in range(4):
+        for kernel in kernels:
+            rotated.append(np.rot90(np.array(kernel, dtype=object), turns).tolist())
+    return rotated
+
+thinning_kernels = rotated_kernels([
+    [[0, 0, 0], [None, 1, None], [1, 1, 1]],
+    [[None, 0, 0], [1, 1, 0], [None, 1, None]],
+])
+thickening_kernels = [[[None if val is None else 1 - val for val in row] for row in kernel] for kernel in thinning_kernels]
+
+def hit_or_miss_until_stable(arr, thicken=False):
+    # after the first sweep a kernel can only newly match around pixels that
+    # changed since it last ran, i.e. during the previous len(kernels) passes
+    kernels = thickening_kernels if thicken else thinning_kernels
+    new_value, center_value = (255, 0) if thicken else (0, 255)
+    height, width = arr.shape[0], arr.shape[1]
+    image = arr.reshape(height, width).copy()
+    flat = image.ravel()
+    if height < 3 or width < 3:
+        return image.reshape(arr.shape)
+
+    tap_sets = []
+    for kernel in kernels:
+        taps = [(val, dy * width + dx) for val, dx, dy in create_ds_kernel([list(row) for row in kernel]) if val is not None]
+        tap_sets.append(taps)
+    neighbourhood = np.array([dy * width + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+    ys, xs = np.mgrid[1:height - 1, 1:width - 1]
+    interior = (ys * width + xs).ravel()
+
+    recent = deque(maxlen=len(kernels))
+    step = 0
+    while step < len(kernels) or any(len(changed) for changed in recent):
+        if step < len(kernels):
+            candidates = interior
+        else:
+            candidates = (np.concatenate(recent)[:, None] + neighbourhood).ravel()
+            cy, cx = np.divmod(candidates, width)
+            candidates = candidates[(cy >= 1) & (cy < height - 1) & (cx >= 1) & (cx < width - 1)]
+        candidates = candidates[flat[candidates] == center_value]
+
+        hit = np.ones(len(candidates), dtype=bool)
+        for val, offset in tap_sets[step % len(kernels)]:
+            hit &= matches_expected(flat[candidates + offset], val)
+        changed = np.unique(candidates[hit])
+        flat[changed] = new_value
+        recent.append(changed)
+        step += 1
+
+    return image.reshape(arr.shape)
@@ -0,0 +1,82 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from processing import apply_filter, filter_halo, filter_output_channels
+from tiled_image import TiledImage, filter_tiled, filter_statistics
+from constants import parallel_min_pixels, parallel_bands_per_worker
+
+pool = None
+
+def process_pool():
+    # started once and reused; forking the Qt process is unsafe, so workers
+    # come from a clean fork server (or are spawned where there is none)
+    global pool
+    if pool is None:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        if context.get_start_method() == "forkserver":
+            context.set_forkserver_preload(["parallel"])
+        pool = ProcessPoolExecutor(os.cpu_count(), mp_context=context)
+    return pool
+
+def shared_array(shm, shape):
+    return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+def filter_band(in_name, out_name, shape, out_shape, y0, y1, halo, filter_type, params):
+    src, dst = SharedMemory(in_name), SharedMemory(out_name)
+    try:
+        arr, out = shared_array(src, shape), shared_array(dst, out_shape)
+        top = max(0, y0 - halo)
+        result = apply_filter(arr[top:min(shape[0], y1 + halo)], filter_type, **params)
+        out[y0:y1] = result.reshape(result.shape[0], result.shape[1], -1)[y0 - top:y1 - top]
+        # the segments can't be closed while views into them exist
+        del arr, out, result
+    finally:
+        src.close()
+        dst.close()
+
+def parallel_filter(arr, filter_type, hist=None, y_range=None, progress=None, **params):
+    # horizontal bands with a halo go to a process pool, pixels travel through
+    # shared memory and only the band bounds and filter parameters get pickled
+    global pool
+    halo = filter_halo(filter_type, **params)
+    workers = os.cpu_count() or 1
+    if halo is None or workers == 1 or arr.shape[0] * arr.shape[1] < parallel_min_pixels:
+        return filter_tiled(TiledImage(arr), filter_type, hist=hist, y_range=y_range, in_memory=True, progress=progress,
+                            **params).pixels
+
+    height, width = arr.shape[0], arr.shape[1]
+    arr = arr.reshape(height, width, -1)
+    hist, y_range = filter_statistics(TiledImage(arr), filter_type, hist, y_range)
+    out_shape = (height, width, filter_output_channels(filter_type, arr.shape[2]))
+    src = SharedMemory(create=True, size=arr.nbytes)
+    dst = SharedMemory(create=True, size=height * width * out_shape[2])
+    futures = []
+    try:
+        shared_array(src, arr.shape)[:] = arr
+        rows = -(-height // (workers * parallel_bands_per_worker))
+        for y0 in range(0, height, rows):
+            futures.append(process_pool().submit(filter_band, src.name, dst.name, arr.shape, out_shape, y0, min(height, y0 + rows),
+                                                 halo, filter_type, dict(params, hist=hist, y_range=y_range)))
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if progress:
+                progress(done, len(futures))
+        return shared_array(dst, out_shape).copy()
+    except BrokenProcessPool:
+        pool = None
+        raise OSError("A filter worker process died, most likely out of memory")
+    finally:
+        # bands still running use the segments, let them finish first
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        src.close()
+        src.unlink()
+        dst.close()
+        dst.unlink()
@@ -0,0 +1,184 @@
+import os
+import zlib
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(el) for el in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(el)) for key, el in value.items()))
+    return value
+
+def stage_keys(source_key, stages):
+    # the output of a stage depends on the source and on every stage up to it
+    keys, prefix = [], (source_key,)
+    for filter_type, params in stages:
+        prefix = prefix + ((filter_type, freeze(params)),)
+        keys.append(prefix)
+    return keys
+
+def pixels_digest(arr):
+    digest = hashlib.blake2b(np.ascontiguousarray(arr), digest_size=16)
+    digest.update(repr(arr.shape).encode())
+    return digest.hexdigest()
+
+def key_digest(key):
+    # keys only hold strings, numbers, None and tuples, whose repr is stable
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+def data_bytes(data):
+    # stage outputs are arrays or tiled images
+    return getattr(data, "pixels", data).nbytes
+
+class FilterPipeline:
+    # ordered (filter type, parameters) stages; outputs are cached per prefix
+    # of the chain in an LRU under a byte budget, so changing a stage reruns
+    # only it and the stages after it; array outputs pushed out of memory are
+    # kept zlib-compressed in spill_dir, itself capped at disk_budget bytes
+    def __init__(self, budget, spill_dir=None, disk_budget=0, compression=1):
+        self.stages = []
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.disk_budget = disk_budget
+        self.compression = compression
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        # superseded runs can still be finishing a stage on another thread
+        self.lock = threading.Lock()
+
+    def set_stage(self, index, filter_type, params):
+        if index == len(self.stages):
+            self.stages.append((filter_type, dict(params)))
+        else:
+            self.stages[index] = (filter_type, dict(params))
+
+    def remove_stage(self, index):
+        del self.stages[index]
+
+    def cached(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        if (data := self.load_spilled(key)) is not None:
+            self.store(key, data)
+        return data
+
+    def store(self, key, data):
+        evicted = []
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = data
+            self.cache_bytes += data_bytes(data)
+            while self.cache_bytes > self.budget:
+                evicted.append(self.cache.popitem(last=False))
+                self.cache_bytes -= data_bytes(evicted[-1][1])
+        for evicted_key, evicted_data in evicted:
+            self.spill(evicted_key, evicted_data)
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, key_digest(key) + ".raw.z")
+
+    def spill(self, key, data):
+        # tiled outputs live in scratch files already and are not kept
+        if self.spill_dir is None or not isinstance(data, np.ndarray) or os.path.exists(self.spill_path(key)):
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        # every writer gets its own temporary file, two sessions can spill the same key
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.spill_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(np.array([data.ndim, *data.shape], dtype="<i8").tobytes())
+                f.write(zlib.compress(np.ascontiguousarray(data), self.compression))
+            os.replace(tmp_path, self.spill_path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.trim_spilled()
+
+    def load_spilled(self, key):
+        if self.spill_dir is None or not os.path.exists(path := self.spill_path(key)):
+            return None
+        try:
+            with open(path, "rb") as f:
+                ndim = int(np.frombuffer(f.read(8), dtype="<i8")[0])
+                shape = tuple(np.frombuffer(f.read(8 * min(max(ndim, 0), 3)), dtype="<i8"))
+                if len(shape) != ndim or min(shape) < 0:
+                    raise ValueError("not a spilled stage output")
+                data = np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8).reshape(shape)
+            os.utime(path)  # the modification time orders spilled entries by last use
+        except FileNotFoundError:  # trimmed meanwhile
+            return None
+        except (OSError, ValueError, IndexError, zlib.error):
+            # a truncated or corrupt file, e.g. from a crash while writing it
+            # in an older session; it would fail every time, so it goes
+            self.remove_spilled(path)
+            return None
+        return data.copy()
+
+    def remove_spilled(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def trim_spilled(self):
+        # other sessions sharing spill_dir can remove entries at any point
+        entries = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.name.endswith(".raw.z"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.disk_budget:
+                break
+            total -= size
+            self.remove_spilled(path)
+
+    def spill_all(self, max_bytes=None):
+        # entries still in memory at exit, so they are there next session;
+        # the most recently used ones go first, at most max_bytes of them, so
+        # quitting doesn't wait for the whole cache to be compressed
+        with self.lock:
+            entries = list(reversed(self.cache.items()))
+        for key, data in entries:
+            if max_bytes is not None:
+                max_bytes -= data_bytes(data)
+                if max_bytes < 0:
+                    break
+            self.spill(key, data)
+
+    def is_cached(self, source_key, stages):
+        with self.lock:
+            return stage_keys(source_key, stages)[-1] in self.cache
+
+    def run(self, source, source_key, stages, apply_stage, progress=None, cache=True):
+        # apply_stage(data, index, filter_type, params, progress) computes one
+        # stage; with cache off, new outputs are not kept
+        keys = stage_keys(source_key, stages)
+        start, data = 0, source
+        for index in reversed(range(len(stages))):
+            if (cached := self.cached(keys[index])) is not None:
+                start, data = index + 1, cached
+                break
+
+        remaining = len(stages) - start
+        for index in range(start, len(stages)):
+            filter_type, params = stages[index]
+            stage_progress = None
+            if progress:
+                stage_progress = lambda done, total, step=index - start: progress(step * total + done, remaining * total)
+            data = apply_stage(data, index, filter_type, params, stage_progress)
+            if cache:
+                self.store(keys[index], data)
+        return data
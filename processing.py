@@ -0,0 +1,145 @@
+import numpy as np
+
+from filters import kernel_padding, apply_kernel, median_filter, sobel
+from histogram import (
+    luminance, histogram, threshold_lut, percent_black_threshold, mean_iterative_threshold, otsu_threshold, stretch_lut,
+    equalize_lut, clahe, float_luminance, stretch_float, replace_luminance
+)
+from constants import clahe_tiles, clahe_clip_limit
+from morphology import (
+    square_structuring_element, binary_morphology, gray_morphology, hit_or_miss, hit_or_miss_until_stable
+)
+
+gray_morphology_filters = {"gray dilation": "dilation", "gray erosion": "erosion", "gray open": "open", "gray close": "close", "top-hat": "top-hat"}
+gray_output_filters = {"dilation", "erosion", "close", "open", "HoM-thin", "HoM-thicken", "sobel"}
+
+def binarize(gray, hist, name, bin_threshold, black_percent):
+    if "percent black" in name:
+        threshold = percent_black_threshold(hist, black_percent)
+    elif "mean iterative" in name:
+        threshold = mean_iterative_threshold(hist)
+    elif "otsu" in name:
+        threshold = otsu_threshold(hist)
+    else: # threshold
+        threshold = bin_threshold
+
+    return threshold_lut(threshold)[gray]
+
+def histogram_filter(arr, gray, hist, name, y_range=None):
+    y = None
+    if "stretch" in name and arr.shape[2] == 3:  # colorful, stretch the unrounded luminance
+        y = float_luminance(arr)
+        new_y = stretch_float(y, y_range)
+    elif "stretch" in name:
+        new_y = stretch_lut(hist)[gray]
+    elif "CLAHE" in name:
+        new_y = clahe(gray, clahe_tiles, clahe_clip_limit)
+    else: # equalization
+        new_y = equalize_lut(hist)[gray]
+
+    return replace_luminance(arr, new_y, y)
+
+def neighbourhood_filter(arr, filter_type, kernel=None, bin_threshold=None, radius=1, sobel_output="L1", converge=False):
+    if filter_type in gray_output_filters or filter_type in gray_morphology_filters:
+        if arr.ndim == 3 and arr.shape[2] == 3:
+            arr = 0.299 * arr[:, :, 0] + 0.587 * arr[:, :, 1] + 0.114 * arr[:, :, 2]
+
+    if filter_type in {"dilation", "erosion", "close", "open", "HoM-thin", "HoM-thicken"}:
+        arr = (arr > bin_threshold).astype(np.uint8) * 255
+
+    if filter_type in gray_morphology_filters:
+        size = 2 * radius + 1
+        out = gray_morphology(arr.astype(np.uint8), gray_morphology_filters[filter_type], size, size)
+    elif filter_type in {"dilation", "erosion"}:
+        out = binary_morphology(arr, [filter_type], kernel)
+    elif filter_type == "close":
+        out = binary_morphology(arr, ["dilation", "erosion"], kernel)
+    elif filter_type == "open":
+        out = binary_morphology(arr, ["erosion", "dilation"], kernel)
+    elif filter_type in {"HoM-thin", "HoM-thicken"} and converge:
+        out = hit_or_miss_until_stable(arr, thicken=filter_type == "HoM-thicken")
+    elif filter_type == "HoM-thin":
+        out = hit_or_miss(arr, kernel)
+        out = np.clip(arr - out, 0, 255)
+    elif filter_type == "HoM-thicken":
+        out = hit_or_miss(arr, kernel)
+        out = np.clip(arr + out, 0, 255)
+    elif filter_type == "median":
+        out = median_filter(arr, radius)
+    elif filter_type == "sobel":
+        out = sobel(arr, sobel_output)
+        if sobel_output == "direction":
+            out = (out + np.pi) * (255 / (2 * np.pi))
+        out = np.clip(out, 0, 255).astype(np.uint8)
+    else:
+        if filter_type == "mean":
+            kernel = [[1/9] * 3 for _ in range(3)]
+        elif filter_type == "sharpening":
+            kernel = [[0, -1, 0], [-1, 5, -1], [0, -1, 0]]
+        elif filter_type == "gaussian":
+            kernel = [[1, 4, 7, 4, 1], [4, 16, 26, 16, 4], [7, 26, 41, 26, 7], [4, 16, 26, 16, 4], [1, 4, 7, 4, 1]]
+            kernel = [[el/273 for el in row] for row in kernel]
+
+        out = apply_kernel(arr, kernel)
+
+    return out
+
+def apply_filter(arr, filter_type, kernel=None, bin_threshold=127, black_percent=50, radius=1, sobel_output="L1",
+                 converge=False, gray=None, hist=None, y_range=None):
+    # gray/hist may be passed in by callers that cache them per image, hist and
+    # y_range by callers that filter the image piece by piece
+    if filter_type.startswith(("binarize", "histo")):
+        if gray is None:
+            gray = luminance(arr)
+        if hist is None:
+            hist = histogram(gray)
+    if filter_type.startswith("binarize"):
+        return binarize(gray, hist, filter_type, bin_threshold, black_percent)
+    if filter_type.startswith("histo"):
+        return histogram_filter(arr, gray, hist, filter_type, y_range)
+    return neighbourhood_filter(arr, filter_type, kernel, bin_threshold, radius, sobel_output, converge)
+
+def filter_halo(filter_type, kernel=None, radius=1, converge=False, **params):
+    # how far from a pixel its result can look, None when it depends on the
+    # whole image; binarization, equalization and stretching only need the
+    # global histogram (or luminance range), CLAHE's grid covers the whole image
+    if filter_type.startswith("binarize") or filter_type in {"histo equalize", "histo stretch"}:
+        return 0
+    if filter_type.startswith("histo") or (converge and filter_type in {"HoM-thin", "HoM-thicken"}):
+        return None
+    if filter_type in gray_morphology_filters:
+        return radius if filter_type in {"gray dilation", "gray erosion"} else 2 * radius
+    if filter_type == "median":
+        return radius
+    if filter_type in {"sobel", "mean", "sharpening"}:
+        return 1
+    if filter_type == "gaussian":
+        return 2
+    if filter_type in {"dilation", "erosion", "open", "close"}:
+        kernel = kernel or square_structuring_element
+    reach = max(max(pads) for pads in kernel_padding(kernel))
+    return 2 * reach if filter_type in {"open", "close"} else reach
+
+def filter_output_channels(filter_type, channels):
+    if filter_type.startswith("binarize") or filter_type in gray_output_filters or filter_type in gray_morphology_filters:
+        return 1
+    return channels
+
+def scale_filter_params(params, factor):
+    # window radii follow the image size, explicit kernels can't be resampled
+    # faithfully and stay as they are
+    params = dict(params)
+    if "radius" in params:
+        params["radius"] = round(params["radius"] * factor)
+    return params
+
+def expand_roi(roi, halo, height, width):
+    y0, y1, x0, x1 = roi
+    return max(0, y0 - halo), min(height, y1 + halo), max(0, x0 - halo), min(width, x1 + halo)
+
+def paste_roi(arr, out, roi, bounds):
+    # out covers bounds, only its roi part goes back; gray results fill every channel
+    y0, y1, x0, x1 = roi
+    top, left = y0 - bounds[0], x0 - bounds[2]
+    arr[y0:y1, x0:x1] = out[top:top + y1 - y0, left:left + x1 - x0]
+    return arr
@@ -0,0 +1,122 @@
+import tempfile
+
+import numpy as np
+
+from histogram import luminance, histogram, float_luminance, clahe_grid, clahe_histograms, clahe_luts, clahe_map, replace_luminance
+from processing import apply_filter, filter_halo
+from constants import tile_size, clahe_tiles, clahe_clip_limit
+
+class TiledImage:
+    # pixels live in a memory-mapped file, only the tiles being worked on
+    # (and whatever pages the OS decides to keep) take up RAM
+    def __init__(self, pixels, file=None):
+        self.pixels = pixels
+        self.file = file
+        self.height, self.width = pixels.shape[0], pixels.shape[1]
+        # set on copies made on write: the tiles that may differ from the original
+        self.patched_tiles = None
+
+    @classmethod
+    def create(cls, height, width, channels, in_memory=False):
+        if in_memory:
+            return cls(np.empty((height, width, channels), dtype=np.uint8))
+        # the scratch file is unlinked already, it goes away with the mapping
+        file = tempfile.TemporaryFile()
+        return cls(np.memmap(file, dtype=np.uint8, mode="w+", shape=(height, width, channels)), file)
+
+    def copy_on_write(self):
+        # a private mapping of the same file, only the pages written to get
+        # copied into memory; images held in memory are copied outright
+        pixels = self.pixels
+        if not isinstance(pixels, np.memmap) or pixels.mode == "c" or not (self.file or pixels.filename):
+            copy = TiledImage(np.array(pixels))
+        else:
+            copy = TiledImage(np.memmap(self.file or pixels.filename, dtype=pixels.dtype, mode="c", offset=pixels.offset,
+                                        shape=pixels.shape))
+        copy.patched_tiles = set()
+        return copy
+
+    def tiles(self, size=tile_size):
+        for y0 in range(0, self.height, size):
+            for x0 in range(0, self.width, size):
+                yield y0, min(y0 + size, self.height), x0, min(x0 + size, self.width)
+
+    def tiles_in(self, y0, y1, x0, x1, size=tile_size):
+        return [tile for tile in self.tiles(size) if tile[0] < y1 and y0 < tile[1] and tile[2] < x1 and x0 < tile[3]]
+
+    def region(self, y0, y1, x0, x1, halo=0):
+        # the halo stops at the image border, the filters pad there themselves
+        # exactly like they do for a whole image
+        top, left = max(0, y0 - halo), max(0, x0 - halo)
+        region = np.array(self.pixels[top:min(self.height, y1 + halo), left:min(self.width, x1 + halo)])
+        return region, y0 - top, x0 - left
+
+    def sample(self, step, y0=0, y1=None, x0=0, x1=None):
+        return np.ascontiguousarray(self.pixels[y0:y1:step, x0:x1:step])
+
+def map_tiles(src, func, halo=0, in_memory=False, progress=None, bounds=False):
+    # with bounds func also gets the tile's (y0, y1, x0, x1)
+    dst = None
+    tiles = list(src.tiles())
+    for done, (y0, y1, x0, x1) in enumerate(tiles, 1):
+        region, top, left = src.region(y0, y1, x0, x1, halo)
+        out = func(region, (y0, y1, x0, x1)) if bounds else func(region)
+        if out.ndim == 2:
+            out = out[:, :, None]
+        if dst is None:
+            dst = TiledImage.create(src.height, src.width, out.shape[2], in_memory)
+        dst.pixels[y0:y1, x0:x1] = out[top:top + y1 - y0, left:left + x1 - x0]
+        if progress:
+            progress(done, len(tiles))
+    return dst
+
+def tiled_histogram(src):
+    hist = np.zeros(256, dtype=np.int64)
+    for y0, y1, x0, x1 in src.tiles():
+        hist += histogram(luminance(src.pixels[y0:y1, x0:x1]))
+    return hist
+
+def tiled_luminance_range(src):
+    low, high = np.float32(np.inf), np.float32(-np.inf)
+    for y0, y1, x0, x1 in src.tiles():
+        y = float_luminance(src.pixels[y0:y1, x0:x1])
+        low, high = min(low, y.min()), max(high, y.max())
+    return low, high
+
+def filter_statistics(src, filter_type, hist=None, y_range=None):
+    # the whole-image statistics a filter run piece by piece needs, gathered
+    # in one pass over the tiles where the caller didn't have them
+    if filter_type.startswith(("binarize", "histo")) and hist is None:
+        hist = tiled_histogram(src)
+    if filter_type == "histo stretch" and src.pixels.shape[2] == 3 and y_range is None:
+        y_range = tiled_luminance_range(src)
+    return hist, y_range
+
+def tiled_clahe(src, in_memory=False, progress=None):
+    # the grid cell histograms are summed over the tiles first, then every
+    # tile maps its pixels with the lookup tables of the cells around them
+    grid = clahe_grid(src.height, src.width, clahe_tiles)
+    hists = 0
+    for y0, y1, x0, x1 in src.tiles():
+        hists = hists + clahe_histograms(luminance(src.pixels[y0:y1, x0:x1]), grid, y0, x0)
+    luts = clahe_luts(hists, clahe_clip_limit)
+
+    def equalize(region, bounds):
+        new_y = clahe_map(luminance(region), luts, src.height, src.width, bounds[0], bounds[2])
+        return replace_luminance(region, new_y)
+    return map_tiles(src, equalize, 0, in_memory, progress, bounds=True)
+
+def filter_tiled(src, filter_type, hist=None, y_range=None, in_memory=False, progress=None, **params):
+    halo = filter_halo(filter_type, **params)
+    if filter_type == "histo CLAHE" and not in_memory:
+        return tiled_clahe(src, in_memory, progress)
+    if halo is None and not in_memory:
+        raise ValueError(f"{filter_type} depends on the whole image and can't run tile by tile")
+    if halo is None:  # fits in memory, so run it in one piece
+        out = apply_filter(src.pixels, filter_type, hist=hist, **params)
+        if progress:
+            progress(1, 1)
+        return TiledImage(out if out.ndim == 3 else out[:, :, None])
+    hist, y_range = filter_statistics(src, filter_type, hist, y_range)
+    return map_tiles(src, lambda region: apply_filter(region, filter_type, hist=hist, y_range=y_range, **params), halo,
+                     in_memory, progress)
@@ -1,6 +1,13 @@
 import numpy as np
 
-def transform_text_to_kernel(text):
+from constants import dont_care_tokens
+
+def parse_kernel_value(el, allow_dont_care):
+    if allow_dont_care and el.lower() in dont_care_tokens:
+        return None
+    return float(el)
+
+def transform_text_to_kernel(text, allow_dont_care=False):
     rows = text.split("\n")
     rows = [row.strip(",") for row in rows]
     rows = [row.split(",") for row in rows]
@@ -9,7 +16,7 @@ def transform_text_to_kernel(text):
     if not all(len(rows[i]) == len(rows[0]) for i in range(1, len(rows))):
         return None
     try:
-        rows = [[float(el.strip()) for el in row] for row in rows]
+        rows = [[parse_kernel_value(el.strip(), allow_dont_care) for el in row] for row in rows]
     except:
         return None
     return rows